@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''
+Approximate nearest neighbour search over normalized sentence vectors with
+random hyperplane locality sensitive hashing (LSH).
+
+Each table hashes a vector to the signs of its projections onto a number of
+random hyperplanes. Vectors with a high cosine similarity are likely to fall
+in the same bucket of at least one table, so only the vectors sharing a
+bucket with the query have their exact similarity computed. More bits per
+table make buckets smaller (faster, lower recall); more tables increase
+recall at the cost of memory and time.
+'''
+
+import numpy
+
+class HyperplaneLSHIndex(object):
+    '''
+    Class to find approximate nearest neighbours of normalized vectors. The
+    vectors are not copied, so a memory mapped matrix can be used.
+    '''
+    def __init__(self, vectors, num_tables=16, num_bits=8, seed=1, chunk_size=10000):
+        '''
+        :param vectors: matrix with one normalized vector per row
+        :param num_tables: number of hash tables
+        :param num_bits: number of hyperplanes (bits of the bucket keys) in
+            each table. At most 64.
+        :param chunk_size: number of vectors hashed at a time, bounding
+            the memory used while building the index
+        '''
+        if not 0 < num_bits <= 64:
+            raise ValueError('The number of bits must be between 1 and 64')
+        
+        self.vectors = vectors
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        
+        num_vectors, num_features = vectors.shape
+        random_state = numpy.random.RandomState(seed)
+        self.hyperplanes = random_state.randn(num_features, num_tables * num_bits).\
+            astype(numpy.float32)
+        
+        # codes[t, i] is the bucket of vector i in table t
+        self.codes = numpy.zeros((num_tables, num_vectors), numpy.uint64)
+        for start in range(0, num_vectors, chunk_size):
+            end = min(start + chunk_size, num_vectors)
+            self.codes[:, start:end] = self.hash_vectors(vectors[start:end]).T
+        
+        # for each table, the vector ids sorted by bucket, and the first
+        # position of each bucket in that order
+        self.sorted_ids = []
+        self.bucket_codes = []
+        self.bucket_starts = []
+        for table_codes in self.codes:
+            order = numpy.argsort(table_codes, kind='mergesort').astype(numpy.int32)
+            sorted_codes = table_codes[order]
+            codes, starts = numpy.unique(sorted_codes, return_index=True)
+            
+            self.sorted_ids.append(order)
+            self.bucket_codes.append(codes)
+            self.bucket_starts.append(numpy.append(starts, num_vectors).astype(numpy.int32))
+    
+    def hash_vectors(self, vectors):
+        '''
+        Return a matrix with the bucket of each given vector (rows) in each
+        table (columns).
+        '''
+        vectors = numpy.atleast_2d(vectors)
+        signs = numpy.dot(vectors, self.hyperplanes) > 0
+        signs = signs.reshape(len(vectors), self.num_tables, self.num_bits)
+        
+        powers = numpy.left_shift(numpy.uint64(1),
+                                  numpy.arange(self.num_bits, dtype=numpy.uint64))
+        return (signs * powers).sum(2, dtype=numpy.uint64)
+    
+    def candidates(self, codes):
+        '''
+        Return an array with the ids of the vectors sharing a bucket with the
+        given codes (one per table) in any table.
+        '''
+        found = []
+        for table, code in enumerate(codes):
+            bucket_codes = self.bucket_codes[table]
+            position = numpy.searchsorted(bucket_codes, code)
+            if position < len(bucket_codes) and bucket_codes[position] == code:
+                starts = self.bucket_starts[table]
+                found.append(self.sorted_ids[table][starts[position]:starts[position + 1]])
+        
+        if not found:
+            return numpy.zeros(0, numpy.int32)
+        
+        return numpy.unique(numpy.concatenate(found))
+    
+    def query(self, vector, k=10, min_score=None, exclude=None, codes=None):
+        '''
+        Return a tuple (ids, similarities) with the approximate k nearest
+        neighbours of the given vector, in decreasing order of similarity.
+        
+        :param min_score: if given, neighbours with lower similarity are discarded
+        :param exclude: optional function taking an array of ids and returning
+            a boolean mask of the ones that must not be returned
+        :param codes: the buckets of the vector, if they are already known
+            (e.g., for a vector in the index, `self.codes[:, i]`)
+        '''
+        if codes is None:
+            codes = self.hash_vectors(vector)[0]
+        
+        ids = self.candidates(codes)
+        if exclude is not None and len(ids):
+            ids = ids[~exclude(ids)]
+        
+        similarities = numpy.dot(self.vectors[ids], vector)
+        if min_score is not None:
+            above = similarities >= min_score
+            ids = ids[above]
+            similarities = similarities[above]
+        
+        if len(ids) > k:
+            # only the top k need to be sorted
+            top = numpy.argpartition(-similarities, k - 1)[:k]
+            ids = ids[top]
+            similarities = similarities[top]
+        
+        order = numpy.argsort(-similarities, kind='mergesort')
+        return ids[order], similarities[order]
+    
+    def memory_usage(self):
+        '''
+        Return the number of bytes used by the index structures, not counting
+        the indexed vectors.
+        '''
+        arrays = [self.hyperplanes, self.codes] + self.sorted_ids + \
+            self.bucket_codes + self.bucket_starts
+        return sum(array.nbytes for array in arrays)
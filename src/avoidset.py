@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compact storage for the sentences that should be avoided in each cluster.
+
+Instead of the full sentence strings, only 64 bit hashes of the normalized
+sentences are stored (see `utils.sentence_hash`). The file starts with a
+fixed header, followed by the sorted hashes of all clusters in a contiguous
+array and a pickled table mapping cluster names to their rows. The hashes are
+memory mapped and only the ones of a requested cluster are read.
+'''
+
+import json
+import struct
+import cPickle
+
+import numpy
+
+import utils
+
+magic = b'AVOIDSET'
+
+# magic string followed by the offset of the cluster table
+header_format = b'<8sQ'
+header_size = struct.calcsize(header_format)
+
+class HashedSentenceSet(object):
+    '''
+    Set-like object with the hashes of the sentences to be avoided in a cluster.
+    It only supports checking whether a sentence is in it.
+    '''
+    def __init__(self, hashes):
+        self.hashes = frozenset(hashes)
+    
+    def __contains__(self, sentence):
+        return utils.sentence_hash(sentence) in self.hashes
+    
+    def __len__(self):
+        return len(self.hashes)
+
+class AvoidSet(object):
+    '''
+    Class to read an avoid set file. Sentences of a cluster are only loaded
+    when requested with `get`.
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            file_magic, table_offset = struct.unpack(header_format, f.read(header_size))
+            if file_magic != magic:
+                raise ValueError('{} is not an avoid set file'.format(filename))
+            
+            f.seek(table_offset)
+            
+            # maps cluster names to tuples (start row, end row)
+            self.clusters = cPickle.load(f)
+        
+        num_hashes = (table_offset - header_size) / 8
+        if num_hashes == 0:
+            # numpy can't map empty files
+            self.hashes = numpy.zeros(0, numpy.uint64)
+        else:
+            self.hashes = numpy.memmap(filename, '<u8', 'r', offset=header_size,
+                                       shape=(num_hashes,))
+    
+    def __contains__(self, cluster):
+        return cluster in self.clusters
+    
+    def __len__(self):
+        return len(self.clusters)
+    
+    def get(self, cluster, default=None):
+        '''
+        Return a `HashedSentenceSet` with the sentences to be avoided in the
+        given cluster, or `default` if the cluster isn't in the file.
+        '''
+        if cluster not in self.clusters:
+            return default
+        
+        start, end = self.clusters[cluster]
+        return HashedSentenceSet(self.hashes[start:end].tolist())
+
+def write_avoid_set(filename, clusters):
+    '''
+    Write an avoid set file.
+    
+    :param clusters: dictionary mapping cluster names to collections of
+        sentence hashes
+    '''
+    table = {}
+    num_hashes = 0
+    with open(filename, 'wb') as f:
+        # the header is written again when the table position is known
+        f.write(struct.pack(header_format, magic, 0))
+        
+        for cluster in sorted(clusters):
+            hashes = numpy.array(sorted(clusters[cluster]), dtype='<u8')
+            table[cluster] = (num_hashes, num_hashes + len(hashes))
+            num_hashes += len(hashes)
+            f.write(hashes.tostring())
+        
+        table_offset = f.tell()
+        cPickle.dump(table, f, -1)
+        
+        f.seek(0)
+        f.write(struct.pack(header_format, magic, table_offset))
+
+def is_avoid_set_file(filename):
+    '''
+    Return True if the given file is in the avoid set format and False
+    otherwise (e.g., a JSON file).
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def load_avoid_data(filename):
+    '''
+    Load the sentences to be avoided per cluster from a JSON file or an avoid
+    set file, detecting the format automatically.
+    
+    In both cases, the returned object has a `get` method that takes a cluster
+    name and returns a collection of sentences (or hashes) supporting `in`,
+    or None if the cluster has no sentences to be avoided.
+    '''
+    if is_avoid_set_file(filename):
+        return AvoidSet(filename)
+    
+    with open(filename, 'rb') as f:
+        return json.load(f)
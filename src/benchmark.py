@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end benchmark of the pair mining pipeline.
+
+It generates a synthetic (but deterministic, given the seed) training corpus
+and cluster tree, and then runs each stage as a separate process, the same
+way it is done in practice: tokenize_clusters.py, vectorspaceanalyzer.py for
+each VSM method, create_index.py and find_rte_candidates.py. For each stage
+it reports the elapsed time, the throughput in sentences per second and the
+peak memory of the process.
+
+Results can be saved as a baseline and later runs compared against it, so
+that changes to the code can be checked for slowdowns and for changes in the
+mined pairs.
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.etree import cElementTree as ET
+
+# function words, used as stopwords by the benchmark models
+stopwords = [u'a', u'o', u'as', u'os', u'de', u'do', u'da', u'dos', u'das', u'em',
+             u'no', u'na', u'um', u'uma', u'que', u'e', u'para', u'por', u'com', u'se']
+
+_letters = u'abcdefghijlmnopqrstuvxzáâãçéêíóôõú'
+_script_dir = os.path.dirname(os.path.abspath(__file__))
+
+class SyntheticCorpusGenerator(object):
+    '''
+    Class to generate text with a Zipfian vocabulary of random words. Cluster
+    documents describe the same events with small variations, so that they
+    contain sentence pairs like the ones mined from real news clusters.
+    '''
+    def __init__(self, vocabulary_size=5000, seed=1):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            length = self.random.randint(2, 10)
+            words.add(u''.join(self.random.choice(_letters) for _ in range(length)))
+        self.vocabulary = sorted(words)
+        self.random.shuffle(self.vocabulary)
+        
+        # cumulative Zipf weights, so frequent words are sampled more often
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in range(1, vocabulary_size + 1):
+            total += 1.0 / rank
+            self.cumulative_weights.append(total)
+    
+    def word(self):
+        if self.random.random() < 0.3:
+            return self.random.choice(stopwords)
+        
+        value = self.random.random() * self.cumulative_weights[-1]
+        low, high = 0, len(self.cumulative_weights) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative_weights[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        
+        return self.vocabulary[low]
+    
+    def sentence_words(self, min_size=6, max_size=25):
+        size = self.random.randint(min_size, max_size)
+        return [self.word() for _ in range(size)]
+    
+    def variation(self, words):
+        '''
+        Return a copy of the given words with a few of them replaced, removed
+        or inserted.
+        '''
+        words = list(words)
+        for _ in range(self.random.randint(2, max(3, len(words) // 2))):
+            position = self.random.randrange(len(words))
+            operation = self.random.random()
+            if operation < 0.6:
+                words[position] = self.word()
+            elif operation < 0.8 and len(words) > 3:
+                del words[position]
+            else:
+                words.insert(position, self.word())
+        
+        return words
+    
+    def render(self, words):
+        '''
+        Return the text of a sentence with the given words. Some of them get
+        numbers, which are normalized by the tokenizer.
+        '''
+        words = list(words)
+        if self.random.random() < 0.2:
+            words.insert(self.random.randrange(len(words)),
+                         unicode(self.random.randint(1, 2000)))
+        
+        text = u' '.join(words)
+        return text[0].upper() + text[1:] + u'.'
+    
+    def write_document(self, path, paragraphs):
+        text = u'\n'.join(u' '.join(self.render(words) for words in sentences)
+                          for sentences in paragraphs)
+        with open(path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+    
+    def generate(self, directory, num_documents=500, num_clusters=100,
+                 documents_per_cluster=5, sentences_per_document=10):
+        '''
+        Create the directories train (with .txt files to train the models) and
+        clusters (one subdirectory per cluster) and a stopwords file inside
+        the given directory. Return a dictionary with the number of sentences
+        written to each one.
+        '''
+        train_dir = os.path.join(directory, 'train')
+        clusters_dir = os.path.join(directory, 'clusters')
+        os.makedirs(train_dir)
+        os.makedirs(clusters_dir)
+        
+        with open(os.path.join(directory, 'stopwords.txt'), 'wb') as f:
+            f.write(u'\n'.join(stopwords).encode('utf-8'))
+        
+        train_sentences = 0
+        for i in range(num_documents):
+            paragraphs = []
+            for _ in range(sentences_per_document // 3 + 1):
+                paragraphs.append([self.sentence_words() for _ in range(3)])
+                train_sentences += 3
+            
+            path = os.path.join(train_dir, 'doc{:06d}.txt'.format(i))
+            self.write_document(path, paragraphs)
+        
+        cluster_sentences = 0
+        for i in range(num_clusters):
+            cluster_dir = os.path.join(clusters_dir, 'cluster{:05d}'.format(i))
+            os.makedirs(cluster_dir)
+            events = [self.sentence_words() for _ in range(sentences_per_document)]
+            
+            for j in range(documents_per_cluster):
+                sentences = []
+                for event in events:
+                    roll = self.random.random()
+                    if roll < 0.6:
+                        sentences.append(self.variation(event))
+                    elif roll < 0.8:
+                        sentences.append(self.sentence_words())
+                
+                if not sentences:
+                    sentences.append(self.sentence_words())
+                
+                cluster_sentences += len(sentences)
+                path = os.path.join(cluster_dir, 'doc{:03d}.txt'.format(j))
+                self.write_document(path, [[sentence] for sentence in sentences])
+        
+        return {'train': train_sentences, 'clusters': cluster_sentences}
+
+def run_stage(name, command, num_sentences, log_file):
+    '''
+    Run a stage of the pipeline in a new process and return a dictionary with
+    its elapsed time (seconds), throughput (sentences per second) and peak
+    memory (MB).
+    
+    :param log_file: file where the output of the process is written
+    '''
+    logging.info('Running {}: {}'.format(name, ' '.join(command)))
+    start_time = time.time()
+    with open(log_file, 'wb') as f:
+        process = subprocess.Popen(command, stdout=f, stderr=subprocess.STDOUT)
+    
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start_time
+    if status != 0:
+        raise RuntimeError('Stage {} failed with status {}; see {}'.format(name, status,
+                                                                          log_file))
+    
+    # ru_maxrss is in kilobytes on Linux
+    return {'seconds': elapsed,
+            'sentences_per_second': num_sentences / max(elapsed, 1e-9),
+            'peak_memory_mb': usage.ru_maxrss / 1024.0}
+
+def pairs_digest(pairs_file):
+    '''
+    Return the number of pairs in the given RTE file and a hash of their
+    sentences. Attributes such as the similarity are not considered, since 
+    they can change slightly in the last digits with different code paths.
+    '''
+    digest = hashlib.md5()
+    num_pairs = 0
+    for pair in ET.parse(pairs_file).getroot().iter('pair'):
+        for sentence in (pair.find('t').text, pair.find('h').text):
+            digest.update(sentence.encode('utf-8') + '\n')
+        num_pairs += 1
+    
+    return num_pairs, digest.hexdigest()
+
+def run_benchmark(directory, methods, num_topics, counts, seed, index_args=(), find_args=()):
+    '''
+    Run all stages over the generated corpus in the given directory and return
+    a dictionary with the results of each one.
+    '''
+    python = sys.executable
+    script = lambda name: os.path.join(_script_dir, name)
+    clusters_dir = os.path.join(directory, 'clusters')
+    stopwords_file = os.path.join(directory, 'stopwords.txt')
+    logs_dir = os.path.join(directory, 'logs')
+    os.makedirs(logs_dir)
+    log = lambda stage: os.path.join(logs_dir, stage + '.log')
+    
+    results = {}
+    results['tokenize_clusters'] = run_stage(
+        'tokenize_clusters', [python, script('tokenize_clusters.py'), clusters_dir],
+        counts['clusters'], log('tokenize_clusters'))
+    
+    for method in methods:
+        model_dir = os.path.join(directory, 'models', method)
+        os.makedirs(model_dir)
+        results['generate_model.' + method] = run_stage(
+            'generate_model ' + method,
+            [python, script('vectorspaceanalyzer.py'), os.path.join(directory, 'train'),
+             stopwords_file, method, '--dir', model_dir, '-n', str(num_topics), '-q',
+             '--seed', str(seed)],
+            counts['train'], log('generate_model.' + method))
+        
+        results['create_index.' + method] = run_stage(
+            'create_index ' + method,
+            [python, script('create_index.py'), clusters_dir, model_dir, '--pre-tokenized',
+             '--force'] + list(index_args),
+            counts['clusters'], log('create_index.' + method))
+        
+        output = os.path.join(directory, 'rte-{}.xml'.format(method))
+        stage = 'find_rte_candidates.' + method
+        results[stage] = run_stage(
+            'find_rte_candidates ' + method,
+            [python, script('find_rte_candidates.py'), clusters_dir, '--vsm', model_dir,
+             '--pre-tokenized', '-o', output] + list(find_args),
+            counts['clusters'], log(stage))
+        
+        results[stage]['pairs'], results[stage]['pairs_md5'] = pairs_digest(output)
+    
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the results side by side with the baseline. Return True if no stage
+    got slower by more than the tolerance (a proportion) and the mined pairs
+    are the same.
+    '''
+    ok = True
+    print('{:<28} {:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+        'stage', 'seconds', 'baseline', 'change', 'peak MB', 'baseline'))
+    for stage in sorted(results):
+        current = results[stage]
+        if stage not in baseline:
+            print('{:<28} {:>10.2f} {:>10}'.format(stage, current['seconds'], '-'))
+            continue
+        
+        previous = baseline[stage]
+        change = current['seconds'] / max(previous['seconds'], 1e-9) - 1
+        flag = ''
+        if change > tolerance:
+            flag = ' SLOWER'
+            ok = False
+        if current.get('pairs_md5') != previous.get('pairs_md5'):
+            flag += ' PAIRS CHANGED ({} pairs, baseline {})'.format(current.get('pairs'),
+                                                                     previous.get('pairs'))
+            ok = False
+        
+        print('{:<28} {:>10.2f} {:>10.2f} {:>+7.1%} {:>10.1f} {:>10.1f}{}'.format(
+            stage, current['seconds'], previous['seconds'], change,
+            current['peak_memory_mb'], previous['peak_memory_mb'], flag))
+    
+    return ok
+
+def print_results(results):
+    print('{:<28} {:>10} {:>14} {:>10}'.format('stage', 'seconds', 'sentences/s', 'peak MB'))
+    for stage in sorted(results):
+        values = results[stage]
+        print('{:<28} {:>10.2f} {:>14.0f} {:>10.1f}'.format(
+            stage, values['seconds'], values['sentences_per_second'],
+            values['peak_memory_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dir', default=None,
+                        help='Directory to generate the corpus and models in. By default, '\
+                        'a temporary directory is used and deleted at the end')
+    parser.add_argument('--documents', type=int, default=500,
+                        help='Number of training documents (default 500)')
+    parser.add_argument('--clusters', type=int, default=100,
+                        help='Number of clusters (default 100)')
+    parser.add_argument('--cluster-documents', type=int, default=5, dest='cluster_documents',
+                        help='Number of documents per cluster (default 5)')
+    parser.add_argument('--sentences', type=int, default=10,
+                        help='Approximate number of sentences per document (default 10)')
+    parser.add_argument('--vocabulary', type=int, default=5000,
+                        help='Vocabulary size (default 5000)')
+    parser.add_argument('--seed', type=int, default=1, 
+                        help='Random seed for the corpus and the models (default 1)')
+    parser.add_argument('--methods', default='lsi,rp',
+                        help='Comma separated VSM methods to benchmark (default lsi,rp)')
+    parser.add_argument('-n', dest='num_topics', type=int, default=100,
+                        help='Number of VSM topics (default 100)')
+    parser.add_argument('--index-args', default='', dest='index_args',
+                        help='Additional arguments to create_index.py, in a single string '\
+                        '(e.g., --index-args="--fast-transform")')
+    parser.add_argument('--find-args', default='', dest='find_args',
+                        help='Additional arguments to find_rte_candidates.py, in a single '\
+                        'string (e.g., --find-args="--batch-similarity --workers 2")')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Save the results to this JSON file (e.g., to use as a baseline)')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file with the results of a previous run to compare to. '\
+                        'It must have been run with the same corpus parameters')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Maximum proportion a stage may be slower than the baseline '\
+                        'before the comparison fails (default 0.1)')
+    parser.add_argument('-v', action='store_true', help='Verbose', dest='verbose')
+    args = parser.parse_args()
+    
+    log_level = logging.INFO if args.verbose else logging.WARN
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=log_level)
+    
+    parameters = {'documents': args.documents, 'clusters': args.clusters,
+                  'cluster_documents': args.cluster_documents, 'sentences': args.sentences,
+                  'vocabulary': args.vocabulary, 'seed': args.seed,
+                  'num_topics': args.num_topics}
+    
+    directory = args.dir if args.dir is not None else tempfile.mkdtemp(prefix='rte-benchmark')
+    try:
+        generator = SyntheticCorpusGenerator(args.vocabulary, args.seed)
+        counts = generator.generate(directory, args.documents, args.clusters,
+                                    args.cluster_documents, args.sentences)
+        print('Generated {train} training sentences and {clusters} cluster sentences'.\
+              format(**counts))
+        
+        results = run_benchmark(directory, args.methods.split(','), args.num_topics, counts,
+                                args.seed, shlex.split(args.index_args), 
+                                shlex.split(args.find_args))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory)
+    
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'wb') as f:
+            json.dump({'parameters': parameters, 'counts': counts, 'stages': results},
+                      f, indent=2, sort_keys=True)
+    
+    if args.baseline is not None:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+        
+        if baseline['parameters'] != parameters:
+            logging.warning('The baseline was run with different parameters: {}'.format(
+                baseline['parameters']))
+        
+        print('')
+        if not compare(results, baseline['stages'], args.tolerance):
+            sys.exit(1)
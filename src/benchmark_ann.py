@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark for the approximate nearest neighbour index used to find candidates
+across clusters. For each LSH configuration, it reports the index memory,
+the build and query times and the recall of the top k neighbours from other
+clusters, compared to an exact search over a sample of sentences.
+'''
+
+import argparse
+import time
+
+import numpy
+
+import annindex
+import vectorstore
+
+def cluster_bounds(store):
+    '''
+    Return two arrays with the start and end rows of the cluster of each row
+    in the store.
+    '''
+    starts = numpy.zeros(store.num_sentences, numpy.int64)
+    ends = numpy.zeros(store.num_sentences, numpy.int64)
+    for start, end, _ in store.clusters.values():
+        starts[start:end] = start
+        ends[start:end] = end
+    
+    return starts, ends
+
+def exact_neighbors(vectors, row, start, end, k, min_score):
+    '''
+    Return the set of the k most similar rows to the given one outside the
+    rows from start to end, with similarity at least min_score.
+    '''
+    similarities = numpy.dot(vectors, vectors[row])
+    similarities[start:end] = -numpy.inf
+    top = numpy.argsort(-similarities, kind='mergesort')[:k]
+    return set(top[similarities[top] >= min_score])
+
+def parse_list(text):
+    return [int(value) for value in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('store', help='Directory with a vector store created by '\
+                        'create_index.py --store')
+    parser.add_argument('-k', type=int, default=10,
+                        help='Number of neighbours per sentence (default 10)')
+    parser.add_argument('--min-score', type=float, default=0.7, dest='min_score',
+                        help='Minimum similarity of neighbours (default 0.7)')
+    parser.add_argument('--tables', type=parse_list, default=[8, 16, 32],
+                        help='Comma separated numbers of LSH tables to test (default 8,16,32)')
+    parser.add_argument('--bits', type=parse_list, default=[6, 8, 12],
+                        help='Comma separated numbers of bits per table to test (default 6,8,12)')
+    parser.add_argument('-n', dest='num_queries', type=int, default=1000,
+                        help='Number of sampled sentences used as queries (default 1000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default 1)')
+    args = parser.parse_args()
+    
+    store = vectorstore.ClusterVectorStore(args.store)
+    vectors = numpy.asarray(store.vectors)
+    starts, ends = cluster_bounds(store)
+    print('{} sentences in {} clusters, {:.1f} MB of vectors'.format(
+        store.num_sentences, len(store), vectors.nbytes / 1e6))
+    
+    random_state = numpy.random.RandomState(args.seed)
+    num_queries = min(args.num_queries, store.num_sentences)
+    queries = random_state.choice(store.num_sentences, num_queries, replace=False)
+    
+    start_time = time.time()
+    expected = [exact_neighbors(vectors, row, starts[row], ends[row], args.k, args.min_score)
+                for row in queries]
+    exact_time = (time.time() - start_time) / max(num_queries, 1)
+    total_expected = sum(len(neighbors) for neighbors in expected)
+    print('Exact search: {:.3f} ms/query, {} neighbours above {}'.format(
+        1000 * exact_time, total_expected, args.min_score))
+    
+    print('{:>6} {:>5} {:>10} {:>10} {:>12} {:>8}'.format('tables', 'bits', 'memory MB',
+                                                         'build s', 'ms/query', 'recall'))
+    for num_tables in args.tables:
+        for num_bits in args.bits:
+            start_time = time.time()
+            index = annindex.HyperplaneLSHIndex(vectors, num_tables, num_bits, args.seed)
+            build_time = time.time() - start_time
+            
+            found = 0
+            start_time = time.time()
+            for row, neighbors in zip(queries, expected):
+                def same_cluster(ids):
+                    return (ids >= starts[row]) & (ids < ends[row])
+                
+                ids, _ = index.query(vectors[row], args.k, args.min_score,
+                                     same_cluster, index.codes[:, row])
+                found += len(neighbors.intersection(ids))
+            query_time = (time.time() - start_time) / max(num_queries, 1)
+            
+            recall = found / float(total_expected) if total_expected else 1.0
+            print('{:>6} {:>5} {:>10.2f} {:>10.2f} {:>12.3f} {:>8.3f}'.format(
+                num_tables, num_bits, index.memory_usage() / 1e6, build_time,
+                1000 * query_time, recall))
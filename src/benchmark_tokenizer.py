@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+'''
+Micro-benchmark for sentence tokenization. It compares the throughput of
+building the regexp tokenizer on every call (as done previously), the
+precompiled module-level tokenizer and the batch API.
+'''
+
+import argparse
+import os
+import time
+
+from nltk.tokenize.regexp import RegexpTokenizer
+
+import utils
+from corpusmanager import CorpusManager
+
+def tokenize_rebuilding(text):
+    '''
+    Tokenize the sentence building a new tokenizer, the way
+    `utils.tokenize_sentence` used to.
+    '''
+    text = utils._digit_regexp.sub('9', text.lower())
+    tokenizer = RegexpTokenizer(utils.tokenizer_regexp)
+    return tokenizer.tokenize(text)
+
+def load_sample(directory, max_sentences):
+    '''
+    Read sentences from the .txt files in the given directory (recursively)
+    until `max_sentences` are read.
+    '''
+    cm = CorpusManager(directory)
+    sentences = []
+    for root, _, files in os.walk(cm.directory):
+        for filename in sorted(files):
+            if not filename.endswith('.txt'):
+                continue
+            
+            path = os.path.join(root, filename)
+            sentences.extend(cm.get_sentences_from_file(path))
+            if len(sentences) >= max_sentences:
+                return sentences[:max_sentences]
+    
+    return sentences
+
+def measure(function, sentences, repeats):
+    '''
+    Return the best throughput (sentences per second) of the given function
+    over `repeats` runs.
+    '''
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        function(sentences)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    
+    return len(sentences) / max(best, 1e-9)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('corpus_dir', help='Directory with sample .txt files')
+    parser.add_argument('-n', dest='num_sentences', type=int, default=20000,
+                        help='Maximum number of sentences to use (default 20000)')
+    parser.add_argument('-r', dest='repeats', type=int, default=3,
+                        help='Number of repetitions; the best one is reported (default 3)')
+    args = parser.parse_args()
+    
+    sentences = load_sample(args.corpus_dir, args.num_sentences)
+    print('Loaded {} sentences'.format(len(sentences)))
+    
+    # sanity check: all implementations must agree
+    expected = [tokenize_rebuilding(sent) for sent in sentences]
+    assert expected == [utils.tokenize_sentence(sent) for sent in sentences]
+    assert expected == utils.tokenize_sentences(sentences)
+    
+    benchmarks = [('rebuilt tokenizer',
+                   lambda sents: [tokenize_rebuilding(sent) for sent in sents]),
+                  ('tokenize_sentence',
+                   lambda sents: [utils.tokenize_sentence(sent) for sent in sents]),
+                  ('tokenize_sentences', utils.tokenize_sentences)]
+    
+    baseline = None
+    for name, function in benchmarks:
+        throughput = measure(function, sentences, args.repeats)
+        if baseline is None:
+            baseline = throughput
+        print('{:<20} {:>12.0f} sentences/s {:>8.2f}x'.format(name, throughput,
+                                                           throughput / baseline))
@@ -10,12 +10,20 @@ class FileAccess(object):
     stopwords = 'stopwords.txt'
     tfidf = 'tfidf.dat'
     lsi = 'lsi.dat'
+    projection = 'projection.npz'
+    bundle = 'vsa-bundle.npz'
     index = 'index.dat'
+    index_shards = 'index-shard'
     lda = 'lda.dat'
     vsa_metadata = 'vsa-metadata.dat'
     rp = 'rp.dat'
-    corpus_manager = 'corpus-manager.dat'
+    corpus_manifest = 'corpus-manifest.dat'
     hdp = 'hdp.dat'
+    sentence_cache = 'sentence-cache.dat'
+    token_stream = 'token-stream.txt'
+    vector_store = 'cluster-vectors.dat'
+    vector_store_hashes = 'cluster-vectors-hashes.dat'
+    vector_store_metadata = 'cluster-vectors-metadata.dat'
     
     def __init__(self, directory=None):
         '''
@@ -4,12 +4,194 @@
 import os
 import logging
 import cPickle
-from collections import OrderedDict
-import nltk
+import multiprocessing
+from array import array
+from collections import OrderedDict, deque
 
 import utils
+import nearduplicates
 from config import FileAccess
 
+# dictionary used by worker processes to convert sentences to bags of words
+_worker_dictionary = None
+
+def _init_worker(dictionary):
+    '''
+    Initialize a worker process. If dictionary is not None, workers yield
+    bags of words instead of tokens.
+    '''
+    global _worker_dictionary
+    _worker_dictionary = dictionary
+
+def _split_file(path):
+    '''
+    Return the path and the sentence spans found in the file.
+    This function is executed by worker processes.
+    '''
+    with open(path, 'rb') as f:
+        text = f.read().decode('utf-8')
+    
+    return path, utils.sentence_spans(text)
+
+def _preprocess_file(path, spans=None):
+    '''
+    Split and tokenize the given file. Return the sentence spans and a list
+    with the tokens (or bag of words) of each sentence.
+    This function is executed by worker processes.
+    
+    :param spans: previously computed sentence spans, or None
+    '''
+    with open(path, 'rb') as f:
+        text = f.read().decode('utf-8')
+    
+    if spans is None:
+        spans = utils.sentence_spans(text)
+    
+    sentences = [text[start:end] for start, end in spans]
+    items = utils.tokenize_sentences(sentences, preprocess=True)
+    if _worker_dictionary is not None:
+        items = [_worker_dictionary.doc2bow(tokens) for tokens in items]
+    
+    return spans, items
+
+def _file_signature(path):
+    '''
+    Return a tuple (size, mtime) describing the current state of the file.
+    '''
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+class SentenceSplitCache(object):
+    '''
+    Class to store the sentence boundaries found in corpus files, so that
+    later passes over the same files don't need to run the sentence splitter.
+    Entries are keyed by the file path and are only valid while the file 
+    size and modification time are unchanged.
+    '''
+    def __init__(self, filename):
+        '''
+        :param filename: the file where the cache is stored. If it exists,
+            its contents are loaded.
+        '''
+        self.filename = filename
+        self.modified = False
+        
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.entries = cPickle.load(f)
+            logging.info('Loaded sentence boundaries of {} files from {}'.format(len(self.entries),
+                                                                                 filename))
+        else:
+            self.entries = {}
+    
+    def lookup(self, path):
+        '''
+        Return the list of (start, end) sentence offsets of the given file,
+        or None if they are not cached or the file has changed.
+        '''
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        
+        signature, offsets = entry
+        if signature != _file_signature(path):
+            return None
+        
+        return zip(offsets[::2], offsets[1::2])
+    
+    def store(self, path, spans):
+        '''
+        Store the sentence offsets found in the given file.
+        '''
+        # a flat array of integers is much more compact than a list of tuples
+        offsets = array('l', (offset for span in spans for offset in span))
+        self.entries[path] = (_file_signature(path), offsets)
+        self.modified = True
+    
+    def save(self):
+        '''
+        Write the cache to its file, if anything changed since it was loaded.
+        '''
+        if not self.modified:
+            return
+        
+        with open(self.filename, 'wb') as f:
+            cPickle.dump(self.entries, f, -1)
+        self.modified = False
+        logging.info('Saved sentence boundaries to {}'.format(self.filename))
+
+class CorpusManifest(object):
+    '''
+    Class to store the list of files in a corpus, in iteration order, along with
+    their size, modification time and number of sentences. It allows updating
+    the corpus metadata by scanning only new or modified files.
+    '''
+    def __init__(self, filename):
+        '''
+        :param filename: the file where the manifest is stored. If it exists,
+            its contents are loaded.
+        '''
+        self.filename = filename
+        self.removed_files = []
+        
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.files = cPickle.load(f)
+            logging.info('Loaded corpus manifest with {} files from {}'.format(len(self.files),
+                                                                              filename))
+        else:
+            # maps paths relative to the corpus root to (size, mtime, num_sentences)
+            self.files = OrderedDict()
+    
+    def scan(self, root_dir, paths):
+        '''
+        Replace the file list with the given paths, keeping the data of 
+        unchanged files. Return the paths of new or modified files, whose 
+        number of sentences must be set with `set_num_sentences`.
+        
+        :param root_dir: the corpus root directory
+        :param paths: full paths of the corpus files, in iteration order
+        '''
+        old_files = self.files
+        self.files = OrderedDict()
+        changed = []
+        
+        for path in paths:
+            relative_path = os.path.relpath(path, root_dir)
+            signature = _file_signature(path)
+            entry = old_files.get(relative_path)
+            
+            if entry is not None and entry[:2] == signature:
+                self.files[relative_path] = entry
+            else:
+                self.files[relative_path] = signature + (None,)
+                changed.append(path)
+        
+        self.removed_files = [path for path in old_files if path not in self.files]
+        return changed
+    
+    def set_num_sentences(self, root_dir, path, num_sentences):
+        '''
+        Set the number of sentences of a file returned by `scan`.
+        '''
+        relative_path = os.path.relpath(path, root_dir)
+        size, mtime, _ = self.files[relative_path]
+        self.files[relative_path] = (size, mtime, num_sentences)
+    
+    def num_sentences(self):
+        '''
+        Return the total number of sentences in the corpus.
+        '''
+        return sum(entry[2] for entry in self.files.itervalues())
+    
+    def save(self):
+        '''
+        Write the manifest to its file.
+        '''
+        with open(self.filename, 'wb') as f:
+            cPickle.dump(self.files, f, -1)
+        logging.info('Saved corpus manifest to {}'.format(self.filename))
+
 class CorpusManager(object):
     '''
     Class to manage huge corpora. It iterates over the documents in a directory.
@@ -17,19 +199,24 @@ class CorpusManager(object):
     Files in subdirectories are included.
     '''
     
-    def __init__(self, directory):
+    def __init__(self, directory, sentence_cache=None):
         '''
         Constructor. By default, iterating over the corpus returns the tokens, 
         not their id's. Use `set_yield_ids` to change this behavior.
         cm.
         
         :param directory: the path to the directory containing the corpus
+        :param sentence_cache: a SentenceSplitCache object used to avoid 
+            splitting the same files more than once, or None
         '''
         # use unicode to make functions from os module return unicode objects
         # this is important to get the correct filenames
         self.directory = unicode(directory)
         self.yield_tokens = True
-        self.length = sum(len(files) for _, _, files in os.walk(self.directory))
+        self.sentence_cache = sentence_cache
+        
+        # only computed when needed, as it requires walking the whole corpus tree
+        self.length = None
     
     def set_yield_tokens(self):
         '''
@@ -50,6 +237,9 @@ class CorpusManager(object):
         '''
         Return the number of documents this corpus manager deals with.
         '''
+        if self.length is None:
+            self.length = sum(1 for _ in self._list_files(self.directory))
+        
         return self.length
     
 #     def __getitem__(self, index):
@@ -74,21 +264,28 @@ class CorpusManager(object):
         or tokenization.
         '''
         text = self.get_text_from_file(path)
+        spans = None
+        if self.sentence_cache is not None:
+            spans = self.sentence_cache.lookup(path)
         
-        # we assume that lines contain whole paragraphs. In this case, we can split
-        # on line breaks, because no sentence will have a line break within it.
-        # also, it helps to properly separate titles without a full stop
-        paragraphs = text.split('\n')
-        sentences = []
-        sent_tokenizer = nltk.data.load('tokenizers/punkt/portuguese.pickle')
+        if spans is None:
+            spans = utils.sentence_spans(text)
+            if self.sentence_cache is not None:
+                self.sentence_cache.store(path, spans)
         
-        for paragraph in paragraphs:
-            # don't change to lower case yet in order not to mess with the
-            # sentence splitter
-            par_sentences = sent_tokenizer.tokenize(paragraph, 'pt')
-            sentences.extend(par_sentences)
+        return [text[start:end] for start, end in spans]
+    
+    def count_sentences_in_file(self, path):
+        '''
+        Return the number of sentences in the given file. If the sentence
+        boundaries are cached, the file is not even read.
+        '''
+        if self.sentence_cache is not None:
+            spans = self.sentence_cache.lookup(path)
+            if spans is not None:
+                return len(spans)
         
-        return sentences        
+        return len(self.get_sentences_from_file(path))
         
     def get_tokens_from_file(self, path): 
         '''
@@ -98,11 +295,26 @@ class CorpusManager(object):
         sentences = self.get_sentences_from_file(path)
         
         all_tokens = [token
-                      for sent in sentences
-                      for token in utils.tokenize_sentence(sent, True)]
+                      for sent_tokens in utils.tokenize_sentences(sentences, True)
+                      for token in sent_tokens]
         
         return all_tokens
     
+    def _list_files(self, path):
+        '''
+        Yield the paths of all .txt files inside the given directory, including
+        subdirectories, in a deterministic order.
+        '''
+        # sort the list because os.listdir returns files in arbitrary order
+        file_list = sorted(os.listdir(path))
+        for filename in file_list:
+            full_path = os.path.join(path, filename)
+            if os.path.isdir(full_path):
+                for item in self._list_files(full_path):
+                    yield item
+            elif filename.endswith('.txt'):
+                yield full_path
+    
     def _iterate_on_dir(self, path):
         '''
         Internal helper recursive function.
@@ -134,81 +346,237 @@ class CorpusManager(object):
         '''
         for item in self._iterate_on_dir(self.directory):
             yield item
+        
+        if self.sentence_cache is not None:
+            self.sentence_cache.save()
                 
 
 class SentenceCorpusManager(CorpusManager):
     '''
     This class provides one sentence at a time. Documents are split into sentences
     on demand, but an initial run is needed in order to compute total corpus size.
+    The number of sentences in each file is kept in a manifest, so that later runs
+    only need to scan new or modified files.
     '''
     def __init__(self, corpus_directory,
-                 load_metadata=False, metadata_directory=None):
+                 load_metadata=False, metadata_directory=None,
+                 sentence_cache=True, workers=1):
         '''
-        :param load_metadata: whether to load previously saved metadata
+        :param load_metadata: whether to load previously saved metadata without
+            checking the corpus directory for new or modified files
         :param metadata_directory: the directory where the metadata is stored.
             If None, defaults to the current directory.
+        :param sentence_cache: whether to keep sentence boundaries of each file
+            in a cache file in the metadata directory, so that files are only
+            run through the sentence splitter once.
+        :param workers: number of processes used to split and tokenize files.
+            Sentences are yielded in the same order regardless of this value.
         '''
-        CorpusManager.__init__(self, corpus_directory)
-        
+        self.workers = workers
         file_acess = FileAccess(metadata_directory)
-        if load_metadata:
-            with open(file_acess.corpus_manager, 'rb') as f:
-                data = cPickle.load(f)
-            self.__dict__.update(data)
-            logging.info('Loaded corpus metadata from {}'.format(file_acess.corpus_manager))
-            logging.info('{} total sentences'.format(self.length))
+        if sentence_cache:
+            cache = SentenceSplitCache(file_acess.sentence_cache)
         else:
-            self.length = self._compute_length(self.directory)
-            data = {'length': self.length}
-            with open(file_acess.corpus_manager, 'wb') as f:
-                cPickle.dump(data, f, -1)
-            
-            logging.info('Saved corpus metadata to {}'.format(file_acess.corpus_manager))
+            cache = None
+        
+        CorpusManager.__init__(self, corpus_directory, cache)
+        self.manifest = CorpusManifest(file_acess.corpus_manifest)
+        self.only_changed_files = False
+        
+        if load_metadata and self.manifest.files:
+            logging.info('Using corpus metadata from {}'.format(file_acess.corpus_manifest))
+            self.changed_files = []
+        else:
+            self.changed_files = self._update_manifest()
+            self.manifest.save()
+        
+        self.length = self.manifest.num_sentences()
+        logging.info('{} total sentences'.format(self.length))
     
-    def _compute_length(self, root_dir):
+    def _update_manifest(self):
         '''
-        Compute the total number of sentences in all files inside `root_dir`.
+        Walk the corpus directory and count the sentences in files that are
+        new or were modified since the manifest was saved. Return their paths.
         '''
-        num_sents = 0
-        logging.info('Counting total number of sentences in directory {}'.format(root_dir))
-        for root, _, files in os.walk(root_dir):
-            for filename in files:
-                if not filename.endswith('.txt'):
-                    continue
-                
-                path = os.path.join(root, filename)
-                num_sents += len(self.get_sentences_from_file(path))
+        logging.info('Scanning corpus directory {}'.format(self.directory))
+        changed_files = self.manifest.scan(self.directory, self._list_files(self.directory))
+        logging.info('{} new or modified files, {} removed'.format(len(changed_files),
+                                                                  len(self.manifest.removed_files)))
         
-        logging.info('Found {} sentences'.format(num_sents))
-        return num_sents
+        if self.workers > 1 and changed_files:
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                for path, spans in pool.imap_unordered(_split_file, changed_files, 16):
+                    if self.sentence_cache is not None:
+                        self.sentence_cache.store(path, spans)
+                    self.manifest.set_num_sentences(self.directory, path, len(spans))
+            finally:
+                pool.terminate()
+        else:
+            for path in changed_files:
+                num_sents = self.count_sentences_in_file(path)
+                self.manifest.set_num_sentences(self.directory, path, num_sents)
+        
+        if self.sentence_cache is not None:
+            self.sentence_cache.save()
+        
+        return changed_files
+    
+    def set_only_changed_files(self, only_changed=True):
+        '''
+        Call this function in order to iterate only over the files that were
+        new or modified when the manifest was updated (`changed_files`), e.g.,
+        to update existing models with them.
+        '''
+        self.only_changed_files = only_changed
     
     def __len__(self):
+        if self.only_changed_files:
+            return sum(self.manifest.files[os.path.relpath(path, self.directory)][2]
+                       for path in self.changed_files)
+        
         return self.length
     
-    def _iterate_on_dir(self, path):
+    def _corpus_files(self):
         '''
-        Internal helper recursive function.
+        Return the full paths of the corpus files, in iteration order.
         '''
-        # sorted file list like in the parent class
-        file_list = sorted(os.listdir(path))
-        for filename in file_list:
-            full_path = os.path.join(path, filename)
-            if os.path.isdir(full_path):
-                for item in self._iterate_on_dir(full_path):
-                    yield item
-            else:
-                # this is a file
-                if not filename.endswith('.txt'):
-                    continue
+        if self.only_changed_files:
+            return list(self.changed_files)
+        
+        return [os.path.join(self.directory, path) for path in self.manifest.files]
+    
+    def __iter__(self):
+        '''
+        Yield the tokens (or the bag of words) of each sentence in the corpus.
+        The manifest provides the file order, so the directory tree is not walked.
+        '''
+        if self.workers > 1:
+            items = self._iterate_in_parallel(self._corpus_files())
+        else:
+            items = self._iterate_on_files(self._corpus_files())
+        
+        for item in items:
+            yield item
+        
+        if self.sentence_cache is not None:
+            self.sentence_cache.save()
+    
+    def _iterate_on_files(self, paths):
+        '''
+        Internal helper function.
+        '''
+        for full_path in paths:
+            sentences = self.get_sentences_from_file(full_path)
+            for tokens in utils.tokenize_sentences(sentences, preprocess=True):
+                if self.yield_tokens:
+                    yield tokens
+                else:
+                    yield self.dictionary.doc2bow(tokens)
+    
+    def _iterate_in_parallel(self, paths):
+        '''
+        Split and tokenize files in worker processes, yielding their sentences
+        in the same order as the sequential iteration.
+        '''
+        dictionary = None if self.yield_tokens else self.dictionary
+        pool = multiprocessing.Pool(self.workers, _init_worker, (dictionary,))
+        
+        # results are collected in the order files were submitted. Only a few 
+        # files per worker are pending at any time, so memory usage is bounded
+        # even if the consumer is slower than the workers
+        max_pending = 4 * self.workers
+        pending = deque()
+        files = iter(paths)
+        
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    full_path = next(files, None)
+                    if full_path is None:
+                        break
+                    
+                    spans = None
+                    if self.sentence_cache is not None:
+                        spans = self.sentence_cache.lookup(full_path)
+                    
+                    result = pool.apply_async(_preprocess_file, (full_path, spans))
+                    pending.append((full_path, spans is None, result))
+                
+                if not pending:
+                    break
                 
-                sentences = self.get_sentences_from_file(full_path)
-                for sentence in sentences:
-                    tokens = utils.tokenize_sentence(sentence, preprocess=True)
+                full_path, new_spans, result = pending.popleft()
+                spans, items = result.get()
+                if new_spans and self.sentence_cache is not None:
+                    self.sentence_cache.store(full_path, spans)
                 
-                    if self.yield_tokens:
-                        yield tokens
-                    else:
-                        yield self.dictionary.doc2bow(tokens)
+                for item in items:
+                    yield item
+        finally:
+            pool.terminate()
+
+class TokenStreamCorpusManager(CorpusManager):
+    '''
+    This class provides one sentence at a time from a token stream file, which 
+    contains one preprocessed and tokenized sentence per line. Reading it is much
+    faster than splitting and tokenizing the raw corpus again, so it is useful
+    when the same corpus must be iterated many times.
+    '''
+    def __init__(self, filename, source=None):
+        '''
+        :param filename: path to the token stream file
+        :param source: a corpus manager yielding one list of tokens per sentence.
+            If given, the token stream file is written from its contents in a
+            single pass over it; otherwise, the file must already exist.
+        '''
+        self.filename = filename
+        self.yield_tokens = True
+        self.sentence_cache = None
+        
+        if source is not None:
+            self.length = self._write_stream(source)
+        else:
+            self.length = self._count_sentences()
+        
+        logging.info('{} sentences in token stream {}'.format(self.length, filename))
+    
+    def _write_stream(self, source):
+        '''
+        Write all sentences yielded by the source to the token stream file and
+        return how many there are.
+        '''
+        logging.info('Writing token stream to {}'.format(self.filename))
+        source.set_yield_tokens()
+        num_sents = 0
+        
+        with open(self.filename, 'wb') as f:
+            for tokens in source:
+                # tokens never contain whitespace
+                line = u'{}\n'.format(u' '.join(tokens))
+                f.write(line.encode('utf-8'))
+                num_sents += 1
+        
+        return num_sents
+    
+    def _count_sentences(self):
+        '''
+        Count the sentences in an existing token stream file.
+        '''
+        with open(self.filename, 'rb') as f:
+            return sum(1 for _ in f)
+    
+    def __iter__(self):
+        '''
+        Yield the tokens (or the bag of words) of each sentence in the stream.
+        '''
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                tokens = line.decode('utf-8').split()
+                if self.yield_tokens:
+                    yield tokens
+                else:
+                    yield self.dictionary.doc2bow(tokens)
 
 class InMemorySentenceCorpusManager(CorpusManager):
     '''
@@ -220,16 +588,24 @@ class InMemorySentenceCorpusManager(CorpusManager):
     
     Only process .txt files. Any other extension is ignored.
     '''
-    def __init__(self, directory, pre_tokenized=False):
+    def __init__(self, directory, pre_tokenized=False, near_duplicate_threshold=None):
         '''
         :param pre_tokenized: indicate that the corpus has already been tokenized;
             tokens should be separated by whitespace.
+        :param near_duplicate_threshold: if given, sentences whose token sets have
+            a Jaccard similarity of at least this value with a previous sentence
+            are removed (see the nearduplicates module)
         '''
         self.directory = unicode(directory)
         self.yield_tokens = True
+        self.sentence_cache = None
         self.pre_tokenized = pre_tokenized
+        self.num_near_duplicates = 0
         self._load_corpus()        
         
+        if near_duplicate_threshold is not None:
+            self._remove_near_duplicates(near_duplicate_threshold)
+        
     def _load_corpus(self):
         '''
         Load the corpus to memory. Exactly repeated sentences are removed.
@@ -274,6 +650,24 @@ class InMemorySentenceCorpusManager(CorpusManager):
                 corpus_sentences[sent] = None
             
         self.sentences = corpus_sentences.keys()
+    
+    def _remove_near_duplicates(self, threshold):
+        '''
+        Remove sentences that are near-duplicates of previous ones, keeping
+        the tokenized cache aligned with the remaining sentences.
+        '''
+        token_lists = [self.get_tokenized_sentence(i) for i in range(len(self.sentences))]
+        duplicates = nearduplicates.find_near_duplicates(token_lists, threshold)
+        
+        kept = [i for i, is_duplicate in enumerate(duplicates) if not is_duplicate]
+        self.sentences = [self.sentences[i] for i in kept]
+        self.tokenized_cache = {new_index: token_lists[old_index]
+                                for new_index, old_index in enumerate(kept)}
+        
+        self.num_near_duplicates = len(duplicates) - len(kept)
+        if self.num_near_duplicates:
+            logging.info('Removed {} near-duplicate sentences out of {} in {}'.format(
+                self.num_near_duplicates, len(duplicates), self.directory))
         
     def get_tokenized_sentence(self, index):
         '''
@@ -7,9 +7,89 @@ of all files contained in a directory.
 
 import argparse
 import logging
+import multiprocessing
 import os
+import time
 
 from vectorspaceanalyzer import VectorSpaceAnalyzer
+from config import FileAccess
+import vectorstore
+import vectorcache
+
+# these are set before worker processes are created, so that workers share
+# the loaded models through copy-on-write memory
+vsa = None
+args = None
+old_store = None
+
+def index_cluster(path):
+    '''
+    Create the index for the cluster in the given path, unless it is already 
+    up to date. Errors are logged and don't interrupt the whole run.
+    
+    Return a tuple (path, number of sentences indexed or None in case of errors,
+    whether the index was already up to date).
+    '''
+    try:
+        if args.convert:
+            return path, 0, not vsa.convert_cluster_index(path)
+        
+        if not args.force and vsa.cluster_index_is_current(path, args.pre_tokenized,
+                                                           args.index_format,
+                                                           args.near_duplicates):
+            return path, 0, True
+        
+        num_sentences = vsa.create_index_for_cluster(path, args.pre_tokenized,
+                                                     args.index_format,
+                                                     args.near_duplicates)
+    except Exception:
+        logging.exception('Error indexing cluster {}'.format(path))
+        return path, None, False
+    
+    return path, num_sentences, False
+
+def vectorize_cluster(path):
+    '''
+    Compute the sentence vectors of the cluster in the given path, unless the
+    existing vector store has them up to date. Errors are logged and don't
+    interrupt the whole run.
+    
+    Return a tuple (path, fingerprint, vectors, hashes). vectors and hashes are
+    None if the existing store is up to date, and fingerprint is None in case
+    of errors.
+    '''
+    try:
+        fingerprint = vsa.cluster_fingerprint(path, args.pre_tokenized, args.near_duplicates)
+        cluster = os.path.basename(path)
+        if not args.force and old_store is not None and cluster in old_store and \
+                old_store.get_fingerprint(cluster) == fingerprint:
+            return path, fingerprint, None, None
+        
+        vectors, hashes = vsa.compute_cluster_vectors(path, args.pre_tokenized,
+                                                      args.near_duplicates)
+    except Exception:
+        logging.exception('Error indexing cluster {}'.format(path))
+        return path, None, None, None
+    
+    return path, fingerprint, vectors, hashes
+
+def add_to_store(results, writer):
+    '''
+    Add the results of `vectorize_cluster` to the vector store writer and yield
+    tuples in the same format as `index_cluster`.
+    '''
+    for path, fingerprint, vectors, hashes in results:
+        cluster = os.path.basename(path)
+        if fingerprint is None:
+            yield path, None, False
+        elif vectors is None:
+            # copy the vectors from the existing store
+            writer.add_cluster(cluster, old_store.get_vectors(cluster),
+                               old_store.get_hashes(cluster), fingerprint)
+            yield path, 0, True
+        else:
+            writer.add_cluster(cluster, vectors, hashes, fingerprint)
+            yield path, len(hashes), False
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -17,14 +97,102 @@ if __name__ == '__main__':
     parser.add_argument('vsa_dir', help='Directory containing saved Vector Space Analyzer')
     parser.add_argument('--pre-tokenized', help='Signal that the corpus has already been tokenized.',
                         action='store_true', dest='pre_tokenized')
+    parser.add_argument('--force', action='store_true',
+                        help='Recreate all indices, even the ones whose cluster and model '\
+                        'did not change')
+    parser.add_argument('--format', choices=['npy', 'pickle'], default='npy',
+                        dest='index_format',
+                        help='Index file format: a raw matrix that can be memory mapped (npy, '\
+                        'the default) or a pickled gensim MatrixSimilarity (pickle)')
+    parser.add_argument('--convert', action='store_true',
+                        help='Only convert existing pickled indices to the npy format')
+    parser.add_argument('--store', default=None,
+                        help='Write the vectors of all clusters to a single vector store in '\
+                        'this directory, instead of one index file per cluster')
+    parser.add_argument('--near-duplicates', type=float, default=None, dest='near_duplicates',
+                        metavar='THRESHOLD',
+                        help='Remove sentences whose token sets have at least this Jaccard '\
+                        'similarity with a previous sentence in the cluster. Use the same '\
+                        'value in find_rte_candidates.py')
+    parser.add_argument('--fast-transform', action='store_true', dest='fast_transform',
+                        help='Use the exported projection of lsi and rp models instead of '\
+                        'gensim to compute sentence vectors')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Load the models from the bundle file (see vectorspaceanalyzer.py '\
+                        '--bundle), creating it if needed. Only lsi and rp')
+    parser.add_argument('--vector-cache', dest='vector_cache', default=None, metavar='FILE',
+                        help='Database file caching sentence vectors across clusters and runs')
+    parser.add_argument('--vector-cache-size', dest='vector_cache_size', type=int, 
+                        default=100000,
+                        help='Maximum number of cached vectors kept in memory by each '\
+                        'process (default 100000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes indexing clusters in parallel (default 1)')
+    parser.add_argument('--report-every', type=int, default=100, dest='report_every',
+                        help='Log progress after this many clusters (default 100)')
     args = parser.parse_args()
     
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', 
                         level=logging.INFO)
     vsa = VectorSpaceAnalyzer()
-    vsa.load_data(args.vsa_dir)
+    vsa.load_data(args.vsa_dir, args.fast_transform, use_bundle=args.bundle)
+    if args.vector_cache is not None:
+        vsa.vector_cache = vectorcache.SentenceVectorCache(args.vector_cache, 
+                                                           args.vector_cache_size)
+    
+    paths = [os.path.join(args.corpus_dir, item)
+             for item in sorted(os.listdir(args.corpus_dir))]
+    paths = [path for path in paths if os.path.isdir(path)]
+    
+    if args.store is not None:
+        if os.path.exists(FileAccess(args.store).vector_store_metadata):
+            old_store = vectorstore.ClusterVectorStore(args.store)
+        
+        writer = vectorstore.ClusterVectorStoreWriter(args.store, vsa.num_topics)
+        
+        # clusters must be added to the store in a fixed order
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+            results = pool.imap(vectorize_cluster, paths)
+        else:
+            results = (vectorize_cluster(path) for path in paths)
+        
+        results = add_to_store(results, writer)
+    
+    elif args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(index_cluster, paths)
+    else:
+        results = (index_cluster(path) for path in paths)
+    
+    start = time.time()
+    num_sentences = 0
+    num_skipped = 0
+    failed = []
+    for i, (path, cluster_sentences, skipped) in enumerate(results, 1):
+        if skipped:
+            num_skipped += 1
+        elif cluster_sentences is None:
+            failed.append(path)
+        else:
+            num_sentences += cluster_sentences
+        
+        if i % args.report_every == 0 or i == len(paths):
+            elapsed = max(time.time() - start, 1e-6)
+            logging.info('Processed {}/{} clusters ({:.1f} clusters/s, {:.1f} sentences/s), '\
+                         '{} up to date, {} errors'.format(i, len(paths), i / elapsed,
+                                                           num_sentences / elapsed,
+                                                           num_skipped, len(failed)))
+    
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    
+    if args.store is not None:
+        writer.close()
+    
+    if vsa.vector_cache is not None:
+        vsa.vector_cache.log_stats()
     
-    for item in os.listdir(args.corpus_dir):
-        path = os.path.join(args.corpus_dir, item)
-        if os.path.isdir(path):
-            vsa.create_index_for_cluster(path, args.pre_tokenized)
+    if failed:
+        logging.warn('{} clusters could not be indexed: {}'.format(len(failed), ', '.join(failed)))
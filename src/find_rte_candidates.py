@@ -6,11 +6,54 @@ Script to generate candidate pairs to the RTE task.
 
 import os
 import logging
-import json
 import argparse
+import multiprocessing
 
 from vectorspaceanalyzer import VectorSpaceAnalyzer
 import utils
+import vectorstore
+import vectorcache
+import avoidset
+import miningstats
+
+# these are set before worker processes are created, so that workers share
+# the loaded models through copy-on-write memory instead of loading them again
+vsa = None
+args = None
+filter_ = None
+avoid_data = None
+store = None
+
+def find_candidates(cluster):
+    '''
+    Find the candidate pairs in the given cluster and return a tuple 
+    (cluster, pairs, stats). stats is a miningstats.MiningStats object, or 
+    None if statistics were not requested.
+    '''
+    cluster_path = os.path.join(args.clusters, cluster)
+    avoid_sentences = avoid_data.get(cluster)
+    stats = miningstats.MiningStats() if args.stats is not None else None
+    
+    new_pairs = vsa.find_rte_candidates_in_cluster(cluster_path,
+                                                   pre_tokenized=args.pre_tokenized,
+                                                   min_score=args.min_score,
+                                                   max_score=args.max_score,
+                                                   num_pairs=args.cluster_pairs,
+                                                   min_alpha=args.min_alpha,
+                                                   max_alpha=args.max_alpha,
+                                                   absolute_min_alpha=args.absolute_alpha,
+                                                   min_t_size=7,
+                                                   min_h_size=7,
+                                                   max_t_size=args.max_t_size,
+                                                   max_h_size=args.max_h_size,
+                                                   filter_out_h=filter_,
+                                                   filter_out_t=filter_,
+                                                   avoid_sentences=avoid_sentences,
+                                                   batch_similarity=args.batch_similarity,
+                                                   vector_store=store,
+                                                   near_duplicate_threshold=args.near_duplicates,
+                                                   stats=stats)
+    return cluster, new_pairs, stats
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
@@ -23,8 +66,8 @@ if __name__ == '__main__':
                         default=0.99, dest='max_score')
     parser.add_argument('--cluster-pairs', help='Candidate pairs per cluster', type=int,
                         default=2)
-    parser.add_argument('--avoid', help='A JSON file listing sentences per cluster that should be avoided. '\
-                        'It can be created with the script list_sentences_by_cluster')
+    parser.add_argument('--avoid', help='A JSON or avoid set file listing sentences per cluster that '\
+                        'should be avoided. It can be created with the script list_sentences_by_cluster')
     parser.add_argument('--absolute-alpha', help='Minimum number of different tokens', type=int,
                         default=3, dest='absolute_alpha')
     parser.add_argument('--min-alpha', type=float, default=0.3, dest='min_alpha',
@@ -40,50 +83,130 @@ if __name__ == '__main__':
                         of the prefixes are filtered out.')
     parser.add_argument('--pre-tokenized', action='store_true', dest='pre_tokenized',
                         help='Signal that the corpus has already been tokenized')
+    parser.add_argument('--batch-similarity', action='store_true', dest='batch_similarity',
+                        help='Compute all similarities in a cluster at once (faster, but '\
+                        'uses memory proportional to the squared cluster size)')
+    parser.add_argument('--store', default=None,
+                        help='Directory with a vector store created by create_index.py --store')
+    parser.add_argument('--near-duplicates', type=float, default=None, dest='near_duplicates',
+                        metavar='THRESHOLD',
+                        help='Remove sentences whose token sets have at least this Jaccard '\
+                        'similarity with a previous sentence in the cluster before mining')
+    parser.add_argument('--cross-clusters', action='store_true', dest='cross_clusters',
+                        help='Pair sentences from different clusters, using an approximate '\
+                        'nearest neighbour index over the vectors in --store')
+    parser.add_argument('--neighbors', type=int, default=10,
+                        help='Neighbours retrieved for each sentence with --cross-clusters '\
+                        '(default 10)')
+    parser.add_argument('--lsh-tables', type=int, default=16, dest='lsh_tables',
+                        help='Number of LSH tables with --cross-clusters (default 16)')
+    parser.add_argument('--lsh-bits', type=int, default=8, dest='lsh_bits',
+                        help='Number of bits in each LSH table with --cross-clusters (default 8). '\
+                        'See benchmark_ann.py to choose these values')
+    parser.add_argument('--fast-transform', action='store_true', dest='fast_transform',
+                        help='Use the exported projection of lsi and rp models instead of '\
+                        'gensim to compute sentence vectors')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Load the models from the bundle file (see vectorspaceanalyzer.py '\
+                        '--bundle), creating it if needed. Only lsi and rp')
+    parser.add_argument('--vector-cache', dest='vector_cache', default=None, metavar='FILE',
+                        help='Database file caching sentence vectors across clusters and runs')
+    parser.add_argument('--vector-cache-size', dest='vector_cache_size', type=int, 
+                        default=100000,
+                        help='Maximum number of cached vectors kept in memory by each '\
+                        'process (default 100000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes mining clusters in parallel (default 1)')
+    parser.add_argument('--stats', default=None, metavar='FILE',
+                        help='Save a JSON report with the time spent in each mining stage '\
+                        'and the number of sentences and candidates rejected for each '\
+                        'reason, per cluster and in total')
     parser.add_argument('-o', '--output', help='File to save the pairs', default='rte.xml')
     
     args = parser.parse_args()
+    if args.cross_clusters and args.store is None:
+        parser.error('--cross-clusters requires --store')
+    if args.cross_clusters and args.stats is not None:
+        parser.error('--stats is not available with --cross-clusters')
 
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', 
                         level=logging.INFO)
 
     vsa = VectorSpaceAnalyzer()
-    vsa.load_data(args.vsm)
+    vsa.load_data(args.vsm, args.fast_transform, use_bundle=args.bundle)
+    if args.vector_cache is not None:
+        vsa.vector_cache = vectorcache.SentenceVectorCache(args.vector_cache, 
+                                                           args.vector_cache_size)
     
     prefixes = utils.read_lines(args.filter_prefixes)
     filter_ = utils.generate_filter(True, prefixes)
     
-    writer = utils.XmlWriter(vsm=vsa.method)
+    if args.store is not None:
+        store = vectorstore.ClusterVectorStore(args.store)
+        if not vsa.vector_store_matches_model(store):
+            if args.cross_clusters:
+                parser.error('the vector store in {} was created with another model'.format(
+                    args.store))
+            
+            logging.warn('The vector store was created with another model; using the '\
+                     'index of each cluster instead')
+            store = None
     
     if args.avoid is not None:
-        with open(args.avoid, 'rb') as f:
-            avoid_data = json.load(f)
+        avoid_data = avoidset.load_avoid_data(args.avoid)
     else:
         avoid_data = {}
     
-    # iterate over the clusters
-    for cluster in os.listdir(args.clusters):
-        cluster_path = os.path.join(args.clusters, cluster)
-        avoid_sentences = avoid_data.get(cluster)
+    # pairs are written as soon as each cluster is done. the file is only 
+    # created now, so that previous results are kept if loading fails
+    writer = utils.StreamingXmlWriter(args.output, vsm=vsa.method)
+    
+    if args.cross_clusters:
+        new_pairs = vsa.find_rte_candidates_across_clusters(args.clusters, store,
+                                                            pre_tokenized=args.pre_tokenized,
+                                                            num_pairs=args.cluster_pairs,
+                                                            min_score=args.min_score,
+                                                            max_score=args.max_score,
+                                                            min_alpha=args.min_alpha,
+                                                            max_alpha=args.max_alpha,
+                                                            absolute_min_alpha=args.absolute_alpha,
+                                                            min_t_size=7,
+                                                            min_h_size=7,
+                                                            max_t_size=args.max_t_size,
+                                                            max_h_size=args.max_h_size,
+                                                            filter_out_h=filter_,
+                                                            filter_out_t=filter_,
+                                                            avoid_data=avoid_data,
+                                                            neighbors=args.neighbors,
+                                                            num_tables=args.lsh_tables,
+                                                            num_bits=args.lsh_bits,
+                                                            near_duplicate_threshold=args.near_duplicates)
+        writer.add_pairs(new_pairs)
+    else:
+        # iterate over the clusters in a fixed order, so that pair ids are
+        # the same in different runs
+        clusters = sorted(os.listdir(args.clusters))
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+            results = pool.imap(find_candidates, clusters)
+        else:
+            results = (find_candidates(cluster) for cluster in clusters)
         
-        new_pairs = vsa.find_rte_candidates_in_cluster(cluster_path,
-                                                       pre_tokenized=args.pre_tokenized,
-                                                       min_score=args.min_score,
-                                                       max_score=args.max_score,
-                                                       num_pairs=args.cluster_pairs,
-                                                       min_alpha=args.min_alpha,
-                                                       max_alpha=args.max_alpha,
-                                                       absolute_min_alpha=args.absolute_alpha,
-                                                       min_t_size=7,
-                                                       min_h_size=7,
-                                                       max_t_size=args.max_t_size,
-                                                       max_h_size=args.max_h_size,
-                                                       filter_out_h=filter_,
-                                                       filter_out_t=filter_,
-                                                       avoid_sentences=avoid_sentences)
+        # results come in the same order as the clusters
+        report = miningstats.MiningReport()
+        for cluster, new_pairs, stats in results:
+            writer.add_pairs(new_pairs, cluster)
+            if stats is not None:
+                report.add_cluster(cluster, stats)
         
-        writer.add_pairs(new_pairs, cluster)
-            
-    # pretty print 
-    writer.write_file(args.output, True)
-    
\ No newline at end of file
+        if args.workers > 1:
+            pool.close()
+            pool.join()
+    
+    writer.close()
+    
+    if args.stats is not None:
+        report.write(args.stats)
+    
+    if vsa.vector_cache is not None:
+        vsa.vector_cache.log_stats()
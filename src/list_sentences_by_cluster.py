@@ -6,6 +6,9 @@ all sentences by cluster.
 
 This is useful to list all sentences previously added to XML files,
 and then avoid using them when creating a new file.
+
+With --binary, a compact avoid set file is created instead, storing
+only hashes of the sentences (see the avoidset module).
 '''
 
 import json
@@ -13,18 +16,40 @@ from collections import defaultdict
 from xml.etree import cElementTree as ET
 import argparse
 
-def process_file(filename):
-    tree = ET.parse(filename)
-    root = tree.getroot()
-    contents = defaultdict(set)
+import utils
+import avoidset
+
+def iterate_pairs(filename):
+    '''
+    Iterate over the pairs in the given XML file, yielding tuples
+    (cluster, t, h). Elements are discarded after being read, so memory
+    usage doesn't depend on the file size.
+    '''
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'pair':
+            yield elem.get('cluster'), elem.find('t').text, elem.find('h').text
+            root.clear()
+
+def process_file(filename, contents=None, hashed=False):
+    '''
+    Add the sentences in the given XML file to a dictionary mapping clusters
+    to sets of sentences, and return it.
     
-    for pair in root:
-        t = pair.find('t')
-        s1 = t.text
-        h = pair.find('h')
-        s2 = h.text
-        cluster = pair.get('cluster')
-        contents[cluster].update([s1, s2])
+    :param contents: the dictionary to be updated. If None, a new one is created.
+    :param hashed: store sentence hashes instead of the sentences
+    '''
+    if contents is None:
+        contents = defaultdict(set)
+    
+    for cluster, s1, s2 in iterate_pairs(filename):
+        if hashed:
+            contents[cluster].update(utils.sentence_hash(sentence)
+                                     for sentence in [s1, s2] if sentence is not None)
+        else:
+            contents[cluster].update([s1, s2])
     
     return contents
 
@@ -32,21 +57,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('input', nargs='*', help='Input XML files')
     parser.add_argument('output', help='Output file')
+    parser.add_argument('--binary', action='store_true',
+                        help='Write a compact avoid set file with sentence hashes '\
+                        'instead of JSON')
     args = parser.parse_args()
     
     all_clusters = defaultdict(set)
     for filename in args.input:
-        file_clusters = process_file(filename)
-        
-        for cluster in file_clusters:
-            new_data = file_clusters[cluster]
-            all_clusters[cluster].update(new_data)
+        process_file(filename, all_clusters, args.binary)
     
-    # change sets to list in order to be JSON serializable
-    for cluster in all_clusters:
-        cluster_set = all_clusters[cluster]
-        all_clusters[cluster] = list(cluster_set)
-
-    with open(args.output, 'wb') as f:
-        json.dump(all_clusters, f, indent=4)
-    
\ No newline at end of file
+    if args.binary:
+        avoidset.write_avoid_set(args.output, all_clusters)
+    else:
+        # change sets to list in order to be JSON serializable
+        for cluster in all_clusters:
+            cluster_set = all_clusters[cluster]
+            all_clusters[cluster] = list(cluster_set)
+        
+        with open(args.output, 'wb') as f:
+            json.dump(all_clusters, f, indent=4)
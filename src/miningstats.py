@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+'''
+Instrumentation of candidate pair mining.
+
+A `MiningStats` object accumulates the time spent in each stage of the mining
+of a cluster and the number of candidates rejected for each reason. A
+`MiningReport` aggregates them per cluster and for the whole run, and saves
+them as JSON.
+'''
+
+import json
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# stages of find_rte_candidates_in_cluster, in the order they happen
+stages = ('corpus', 'index', 'transform', 'similarity', 'filtering')
+
+class MiningStats(object):
+    '''
+    Class to accumulate stage times (in seconds) and counters.
+    
+    Counters of T sentences count each sentence once. Counters of rejected
+    H candidates count each sentence with similarity above the minimum score
+    to a T once, with the first reason it was rejected.
+    '''
+    def __init__(self):
+        self.times = dict.fromkeys(stages, 0.0)
+        self.counts = defaultdict(int)
+    
+    def add_time(self, stage, seconds):
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+    
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Context manager adding the time spent inside it to the given stage.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+    
+    def count(self, counter, number=1):
+        self.counts[counter] += number
+    
+    def merge(self, other):
+        '''
+        Add the times and counts of another MiningStats object to this one.
+        '''
+        for stage, seconds in other.times.items():
+            self.add_time(stage, seconds)
+        
+        for counter, number in other.counts.items():
+            self.count(counter, number)
+    
+    def to_dict(self):
+        return {'times': dict(self.times), 'counts': dict(self.counts)}
+
+class MiningReport(object):
+    '''
+    Class to aggregate the statistics of each mined cluster.
+    '''
+    def __init__(self):
+        self.total = MiningStats()
+        self.clusters = OrderedDict()
+        self.start_time = time.time()
+    
+    def add_cluster(self, cluster, stats):
+        self.clusters[cluster] = stats
+        self.total.merge(stats)
+    
+    def to_dict(self):
+        report = self.total.to_dict()
+        report['clusters'] = OrderedDict((cluster, stats.to_dict())
+                                         for cluster, stats in self.clusters.items())
+        report['num_clusters'] = len(self.clusters)
+        report['wall_time'] = time.time() - self.start_time
+        return report
+    
+    def write(self, filename):
+        '''
+        Save the report as a JSON file.
+        '''
+        with open(filename, 'wb') as f:
+            json.dump(self.to_dict(), f, indent=2)
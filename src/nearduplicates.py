@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+'''
+Detection of near-duplicate sentences with MinHash and locality sensitive
+hashing (LSH).
+
+Each sentence is represented by the set of its tokens, and two sentences are
+near-duplicates if the Jaccard similarity of their sets is at least a given
+threshold. MinHash signatures are split into bands; sentences sharing the
+values of any band are candidates, which are then checked with the exact
+Jaccard similarity.
+'''
+
+import zlib
+from collections import defaultdict
+
+import numpy
+
+# a Mersenne prime larger than any token hash
+_prime = (1 << 61) - 1
+
+def _choose_bands(num_permutations, threshold):
+    '''
+    Return a tuple (bands, rows) with bands * rows == num_permutations such
+    that the LSH threshold (1 / bands) ** (1 / rows) is the closest to the
+    given one.
+    '''
+    options = [(bands, num_permutations / bands)
+               for bands in range(1, num_permutations + 1)
+               if num_permutations % bands == 0]
+    
+    def distance(option):
+        bands, rows = option
+        return abs((1.0 / bands) ** (1.0 / rows) - threshold)
+    
+    return min(options, key=distance)
+
+def jaccard(set1, set2):
+    '''
+    Return the Jaccard similarity between two sets.
+    '''
+    if not set1 and not set2:
+        return 1.0
+    
+    return len(set1 & set2) / float(len(set1 | set2))
+
+class MinHasher(object):
+    '''
+    Class to compute MinHash signatures of token sets. The same seed always
+    yields the same signatures.
+    '''
+    def __init__(self, num_permutations=64, seed=1):
+        random_state = numpy.random.RandomState(seed)
+        
+        # universal hashing (a * x + b) mod p, with x a 32 bit token hash.
+        # a is kept below 2 ** 31 so that the product doesn't overflow
+        self.a = random_state.randint(1, 1 << 31, num_permutations).astype(numpy.uint64)
+        self.b = random_state.randint(0, 1 << 31, num_permutations).astype(numpy.uint64)
+        self.num_permutations = num_permutations
+    
+    def signature(self, tokens):
+        '''
+        Return the MinHash signature of the given set of tokens as an array.
+        '''
+        if not tokens:
+            return numpy.zeros(self.num_permutations, numpy.uint64)
+        
+        token_hashes = numpy.array([zlib.crc32(token.encode('utf-8')) & 0xffffffff
+                                    for token in tokens], dtype=numpy.uint64)
+        values = (numpy.outer(token_hashes, self.a) + self.b) % _prime
+        return values.min(0)
+
+def find_near_duplicates(token_lists, threshold, num_permutations=64, seed=1):
+    '''
+    Return a list of booleans indicating which sentences are near-duplicates
+    of some previous sentence that was not itself marked as a duplicate.
+    
+    :param token_lists: list with the tokens of each sentence
+    :param threshold: minimum Jaccard similarity between the token sets of two
+        sentences for them to be considered near-duplicates
+    :param num_permutations: number of hash functions in the MinHash signatures.
+        More functions make it less likely to miss near-duplicates.
+    '''
+    hasher = MinHasher(num_permutations, seed)
+    
+    # pairs exactly at the LSH threshold are only found half of the time, so it
+    # is set lower. false candidates are discarded by the exact verification
+    bands, rows = _choose_bands(num_permutations, 0.7 * threshold)
+    
+    # maps (band number, band values) to the kept sentences with them
+    buckets = defaultdict(list)
+    kept_sets = {}
+    duplicates = []
+    
+    for i, tokens in enumerate(token_lists):
+        token_set = frozenset(tokens)
+        signature = hasher.signature(token_set)
+        keys = [(band, signature[band * rows:(band + 1) * rows].tostring())
+                for band in range(bands)]
+        
+        candidates = set()
+        for key in keys:
+            candidates.update(buckets.get(key, []))
+        
+        is_duplicate = any(jaccard(token_set, kept_sets[j]) >= threshold
+                           for j in sorted(candidates))
+        duplicates.append(is_duplicate)
+        if is_duplicate:
+            continue
+        
+        kept_sets[i] = token_set
+        for key in keys:
+            buckets[key].append(i)
+    
+    return duplicates
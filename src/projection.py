@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''
+Lightweight transformation of bags of words to topic space, without gensim.
+
+For the lsi and rp methods, the transformation of a bag of words is linear
+(apart from the TF-IDF normalization used with lsi), so it can be exported
+as plain arrays: the vocabulary, the IDF weight of each term and a
+projection matrix. Batches of documents are then transformed with a single
+sparse-dense matrix product.
+'''
+
+import numpy
+import scipy.sparse
+
+def save_projection(filename, tokens, matrix, idfs=None, **metadata):
+    '''
+    Save a projection to a numpy .npz file.
+    
+    :param tokens: list of the dictionary tokens, in the order of their ids
+    :param matrix: matrix with shape (number of topics, number of terms)
+    :param idfs: array with the IDF weight of each term. If given, bags of
+        words are weighted by them and normalized to unit length before being
+        projected, as done by gensim's TfidfModel.
+    :param metadata: any other named arguments are saved as scalars and 
+        available in the `metadata` attribute of the loaded projection
+    '''
+    arrays = {'tokens': numpy.array(tokens, dtype=numpy.unicode_),
+              'matrix': numpy.asarray(matrix, dtype=numpy.float32)}
+    if idfs is not None:
+        arrays['idfs'] = numpy.asarray(idfs, dtype=numpy.float64)
+    
+    for key, value in metadata.items():
+        arrays['metadata_' + key] = numpy.array(value)
+    
+    with open(filename, 'wb') as f:
+        numpy.savez(f, **arrays)
+
+class Vocabulary(object):
+    '''
+    Mapping between tokens and their ids. It has the parts of the interface
+    of gensim's Dictionary needed to transform sentences.
+    '''
+    def __init__(self, tokens):
+        '''
+        :param tokens: list of tokens, in the order of their ids
+        '''
+        self.id2token = list(tokens)
+        self.token2id = {token: i for i, token in enumerate(self.id2token)}
+    
+    def __len__(self):
+        return len(self.id2token)
+    
+    def __getitem__(self, token_id):
+        return self.id2token[token_id]
+    
+    def doc2bow(self, tokens):
+        '''
+        Return the bag of words of the given tokens, ignoring the ones not
+        in the vocabulary.
+        '''
+        counts = {}
+        for token in tokens:
+            if token in self.token2id:
+                token_id = self.token2id[token]
+                counts[token_id] = counts.get(token_id, 0) + 1
+        
+        return sorted(counts.items())
+
+class DenseProjection(object):
+    '''
+    Class to transform bags of words to topic space with an exported projection.
+    '''
+    def __init__(self, filename, eps=1e-12):
+        '''
+        :param filename: file saved with `save_projection`
+        :param eps: terms with an IDF weight up to this value are ignored,
+            as done by gensim
+        '''
+        data = numpy.load(filename)
+        self.matrix = data['matrix']
+        self.num_topics, self.num_terms = self.matrix.shape
+        self.vocabulary = Vocabulary(data['tokens'].tolist())
+        self.metadata = {key[len('metadata_'):]: data[key].item() 
+                         for key in data.files if key.startswith('metadata_')}
+        
+        if 'idfs' in data.files:
+            self.idfs = data['idfs']
+            self.idfs[numpy.abs(self.idfs) <= eps] = 0
+        else:
+            self.idfs = None
+    
+    def _bow_matrix(self, bows):
+        '''
+        Return a sparse matrix with one row for each bag of words, weighted
+        and normalized if the projection has IDF weights.
+        '''
+        rows = []
+        columns = []
+        data = []
+        for i, bow in enumerate(bows):
+            for term_id, count in bow:
+                rows.append(i)
+                columns.append(term_id)
+                data.append(count)
+        
+        shape = (len(bows), self.num_terms)
+        matrix = scipy.sparse.csr_matrix((numpy.array(data, dtype=numpy.float64),
+                                          (rows, columns)), shape=shape)
+        if self.idfs is None:
+            return matrix
+        
+        matrix = matrix.multiply(self.idfs).tocsr()
+        norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(1)).ravel())
+        norms[norms == 0] = 1
+        return scipy.sparse.diags(1 / norms).dot(matrix)
+    
+    def transform_batch(self, bows):
+        '''
+        Return a matrix with the topic space representation of each of the
+        given bags of words (rows).
+        '''
+        bows = list(bows)
+        matrix = self._bow_matrix(bows)
+        return numpy.asarray(matrix.dot(self.matrix.T), dtype=numpy.float32)
+    
+    def transform(self, bow):
+        '''
+        Return an array with the topic space representation of the given
+        bag of words.
+        '''
+        return self.transform_batch([bow])[0]
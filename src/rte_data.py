@@ -11,10 +11,8 @@ from __future__ import unicode_literals
 
 import argparse
 import os
-from xml.dom import minidom
-from xml.etree import cElementTree as ET
 
-import nltk
+import utils
 
 class Pair(object):
     '''
@@ -51,28 +49,8 @@ def write_rte_file(filename, pairs, task='', entailment='UNKNOWN', **attribs):
     :param entailment: the entailment attribute. Should be either
         'YES', 'NO' or 'UNKNOWN'.
     '''
-    root = ET.Element('entailment-corpus')
-    for i, pair in enumerate(pairs, 1):
-        xml_attribs = {'id':str(i), 'task':task, 'entailment':entailment}
-        
-        # add any other attributes supplied in the function call or the pair
-        xml_attribs.update(attribs)
-        xml_attribs.update(pair.attribs)
-        
-        xml_pair = ET.SubElement(root, 'pair', xml_attribs)
-        xml_t = ET.SubElement(xml_pair, 't', pair.t_attribs)
-        xml_h = ET.SubElement(xml_pair, 'h', pair.h_attribs)
-        xml_t.text = pair.t.strip()
-        xml_h.text = pair.h.strip()
-    
-#     tree = ET.ElementTree(root)
-#     tree.write(filename, 'utf-8', True)
-    
-    # produz XML com formatação legível (pretty print)
-    xml_string = ET.tostring(root, 'utf-8')
-    reparsed = minidom.parseString(xml_string)
-    with open(filename, 'wb') as f:
-        f.write(reparsed.toprettyxml('    ', '\n', 'utf-8'))
+    with utils.StreamingXmlWriter(filename) as writer:
+        writer.add_pairs(pairs, task=task, entailment=entailment, **attribs)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -80,6 +58,7 @@ if __name__ == '__main__':
     parser.add_argument('output', help='Arquivo XML para ser salvo no formato RTE')
     args = parser.parse_args()
     
+    import nltk
     items = os.listdir(args.input)
     pairs = []
     for item in items:
@@ -12,7 +12,6 @@ It will
 import argparse
 import os
 import logging
-import nltk
 
 import utils
 
@@ -39,15 +38,7 @@ def recursive_run(directory, only_lines, only_tokens):
         with open(full_path, 'rb') as f:
             text = unicode(f.read(), 'utf-8')
         
-        paragraphs = text.split('\n')
-        sentences = []
-        sent_tokenizer = nltk.data.load('tokenizers/punkt/portuguese.pickle')
-        
-        for paragraph in paragraphs:
-            # don't change to lower case yet in order not to mess with the
-            # sentence splitter
-            par_sentences = sent_tokenizer.tokenize(paragraph, 'pt')
-            sentences.extend(par_sentences)
+        sentences = utils.split_sentences(text)
         
         if not only_tokens:
             text = '\n'.join(sentences)
@@ -57,8 +48,7 @@ def recursive_run(directory, only_lines, only_tokens):
         if not only_lines:
             tokenized_path = full_path.replace('.txt', '.token')
             with open(tokenized_path, 'wb') as f:
-                for sentence in sentences:
-                    tokens = utils.tokenize_sentence(sentence, True)
+                for tokens in utils.tokenize_sentences(sentences, True):
                     line = '%s\n' % ' '.join(tokens)
                     f.write(line.encode('utf-8'))
         
@@ -5,9 +5,10 @@ Utility functions.
 '''
 
 import re
+import hashlib
+import struct
+import importlib
 from xml.etree import cElementTree as ET
-from xml.dom import minidom
-from nltk.tokenize.regexp import RegexpTokenizer
 
 def generate_filter(ending_without_punctuation=False, starting_with=None):
     '''
@@ -64,15 +65,32 @@ def detokenize(tokens):
     s = re.sub(' ([.,;:?!()])', r'\1', s)
     return s
 
-def tokenize_sentence(text, preprocess=True):
+def sentence_hash(sentence):
     '''
-    Tokenize the given sentence and applies preprocessing if requested 
-    (conversion to lower case and digit substitution).
+    Return a 64 bit integer hash of the given sentence. Differences in
+    whitespace are ignored.
     '''
-    if preprocess:
-        text = re.sub(r'\d', '9', text.lower())
+    normalized = u' '.join(sentence.split())
+    digest = hashlib.md5(normalized.encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+class LazyModule(object):
+    '''
+    Proxy to a module that is only imported when one of its attributes is
+    accessed. Used for heavy dependencies (such as gensim), so that scripts
+    that don't need them start faster.
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
     
-    tokenizer_regexp = ur'''(?ux)
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        
+        return getattr(self._module, attribute)
+
+tokenizer_regexp = ur'''(?ux)
     ([^\W\d_]\.)+|                # one letter abbreviations, e.g. E.U.A.
     \d{1,3}(\.\d{3})*(,\d+)|      # numbers in format 999.999.999,99999
     \d{1,3}(,\d{3})*(\.\d+)|      # numbers in format 999,999,999.99999
@@ -89,9 +107,157 @@ def tokenize_sentence(text, preprocess=True):
     \.{3,}|                       # ellipsis or sequences of dots
     \S                            # any non-space character
     '''
-    tokenizer = RegexpTokenizer(tokenizer_regexp)
+_digit_regexp = re.compile(r'\d')
+
+# the tokenizer is built only once, since compiling this regular expression
+# is much more expensive than applying it to a single sentence
+_tokenizer = None
+
+def get_tokenizer():
+    '''
+    Return the regexp tokenizer, creating it (and importing nltk) only once
+    per process.
+    '''
+    global _tokenizer
+    if _tokenizer is None:
+        from nltk.tokenize.regexp import RegexpTokenizer
+        _tokenizer = RegexpTokenizer(tokenizer_regexp)
     
-    return tokenizer.tokenize(text)
+    return _tokenizer
+
+def tokenize_sentence(text, preprocess=True):
+    '''
+    Tokenize the given sentence and applies preprocessing if requested 
+    (conversion to lower case and digit substitution).
+    '''
+    if preprocess:
+        text = _digit_regexp.sub('9', text.lower())
+    
+    return get_tokenizer().tokenize(text)
+
+def tokenize_sentences(sentences, preprocess=True):
+    '''
+    Tokenize all the given sentences and return a list of token lists.
+    
+    :param sentences: iterable of sentences
+    :param preprocess: whether to convert to lower case and substitute digits.
+        Use False if the sentences are already preprocessed (e.g., lines read
+        from the .token files written by tokenize_clusters), which skips
+        this pass altogether.
+    '''
+    tokenize = get_tokenizer().tokenize
+    if not preprocess:
+        return [tokenize(sentence) for sentence in sentences]
+    
+    substitute = _digit_regexp.sub
+    return [tokenize(substitute('9', sentence.lower()))
+            for sentence in sentences]
+
+# the Punkt model is loaded on first use and then shared by all callers
+_sentence_splitter = None
+
+def get_sentence_splitter():
+    '''
+    Return the Portuguese Punkt sentence splitter, loading it only once per process.
+    '''
+    global _sentence_splitter
+    if _sentence_splitter is None:
+        import nltk.data
+        _sentence_splitter = nltk.data.load('tokenizers/punkt/portuguese.pickle')
+    
+    return _sentence_splitter
+
+def sentence_spans(text):
+    '''
+    Return a list of (start, end) offsets of the sentences in the given text.
+    
+    We assume that lines contain whole paragraphs. In this case, we can split
+    on line breaks, because no sentence will have a line break within it.
+    Also, it helps to properly separate titles without a full stop.
+    '''
+    sent_tokenizer = get_sentence_splitter()
+    spans = []
+    paragraph_start = 0
+    
+    for paragraph in text.split('\n'):
+        # don't change to lower case yet in order not to mess with the
+        # sentence splitter
+        for start, end in sent_tokenizer.span_tokenize(paragraph, True):
+            spans.append((paragraph_start + start, paragraph_start + end))
+        
+        # skip the line break too
+        paragraph_start += len(paragraph) + 1
+    
+    return spans
+
+def split_sentences(text):
+    '''
+    Split the given text into a list of sentences, without any preprocessing
+    or tokenization.
+    '''
+    return [text[start:end] for start, end in sentence_spans(text)]
+
+def _escape_xml(data):
+    '''
+    Escape special characters in XML text or attribute values.
+    '''
+    return data.replace('&', '&amp;').replace('<', '&lt;').\
+        replace('"', '&quot;').replace('>', '&gt;')
+
+def _start_tag(element):
+    '''
+    Return the opening of the tag of the given element with its attributes
+    (sorted by name), without the closing ">".
+    '''
+    attributes = [u' {}="{}"'.format(name, _escape_xml(value))
+                  for name, value in sorted(element.attrib.items())]
+    return u'<{}{}'.format(element.tag, u''.join(attributes))
+
+def write_pretty_element(f, element, level=0, indent='    '):
+    '''
+    Write the given ElementTree element to a file, encoded in utf-8, with one
+    element per line and children indented. The output is the same as the
+    pretty printing done by minidom, but without building a DOM tree.
+    
+    :param level: indentation level of the element
+    '''
+    prefix = indent * level
+    start = _start_tag(element)
+    children = list(element)
+    
+    if children:
+        f.write(u'{}{}>\n'.format(prefix, start).encode('utf-8'))
+        for child in children:
+            write_pretty_element(f, child, level + 1, indent)
+        f.write(u'{}</{}>\n'.format(prefix, element.tag).encode('utf-8'))
+    elif element.text:
+        f.write(u'{}{}>{}</{}>\n'.format(prefix, start, _escape_xml(element.text), 
+                                       element.tag).encode('utf-8'))
+    else:
+        f.write(u'{}{}/>\n'.format(prefix, start).encode('utf-8'))
+
+def create_pair_element(pair, xml_attribs, parent=None):
+    '''
+    Create and return an XML element for the given pair.
+    
+    :param xml_attribs: attributes of the pair element. Any attributes present
+        in the pair object are added to it.
+    :param parent: if given, the pair is created as its subelement
+    '''
+    xml_attribs = dict(xml_attribs)
+    xml_attribs.update(pair.attribs)
+    
+    if parent is None:
+        xml_pair = ET.Element('pair', xml_attribs)
+    else:
+        xml_pair = ET.SubElement(parent, 'pair', xml_attribs)
+    
+    xml_t = ET.SubElement(xml_pair, 't', pair.t_attribs)
+    xml_h = ET.SubElement(xml_pair, 'h', pair.h_attribs)
+    xml_t.text = pair.t.strip()
+    xml_h.text = pair.h.strip()
+    
+    return xml_pair
 
 class XmlWriter(object):
     '''
@@ -118,25 +284,64 @@ class XmlWriter(object):
             if cluster is not None:
                 xml_attribs['cluster'] = str(cluster)
             
-            # add any other attributes present in the pair
-            xml_attribs.update(pair.attribs)
-            
-            xml_pair = ET.SubElement(self.root, 'pair', xml_attribs)
-            xml_t = ET.SubElement(xml_pair, 't', pair.t_attribs)
-            xml_h = ET.SubElement(xml_pair, 'h', pair.h_attribs)
-            xml_t.text = pair.t.strip()
-            xml_h.text = pair.h.strip()
+            create_pair_element(pair, xml_attribs, self.root)
     
     def write_file(self, filename, pretty_print=False):
         '''
         Write the actual XML file
         '''
         if pretty_print:
-            xml_string = ET.tostring(self.root, 'utf-8')
-            reparsed = minidom.parseString(xml_string)
-        
             with open(filename, 'wb') as f:
-                f.write(reparsed.toprettyxml('    ', '\n', 'utf-8'))
+                f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+                write_pretty_element(f, self.root)
         else:
             tree = ET.ElementTree(self.root)
             tree.write(filename, 'utf-8', True)
+
+class StreamingXmlWriter(object):
+    '''
+    Class to write pairs to an indented XML file as soon as they are added.
+    Memory usage doesn't grow with the number of pairs.
+    
+    Call `close` after adding all pairs, or use it in a with statement.
+    '''
+    def __init__(self, filename, **attribs):
+        '''
+        Create the file and write the root element. Any named arguments are
+        given to the XML root.
+        '''
+        self.root = ET.Element('entailment-corpus', attribs)
+        self.pair_id = 1
+        self.file = open(filename, 'wb')
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.file.write(u'{}>\n'.format(_start_tag(self.root)).encode('utf-8'))
+    
+    def add_pairs(self, pairs, cluster=None, **attribs):
+        '''
+        Write the given pairs to the file. Any named arguments are added as
+        attributes of all pairs.
+        '''
+        for pair in pairs:
+            xml_attribs = {'id': str(self.pair_id), 
+                           'entailment': 'UNKNOWN'}
+            self.pair_id += 1
+            
+            if cluster is not None:
+                xml_attribs['cluster'] = str(cluster)
+            
+            xml_attribs.update(attribs)
+            xml_pair = create_pair_element(pair, xml_attribs)
+            write_pretty_element(self.file, xml_pair, 1)
+    
+    def close(self):
+        '''
+        Close the root element and the file.
+        '''
+        self.file.write(u'</{}>\n'.format(self.root.tag).encode('utf-8'))
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *_):
+        self.close()
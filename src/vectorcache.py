@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+'''
+Content addressed cache of sentence vectors.
+
+Vectors are keyed by a hash of the sentence tokens and of the fingerprint of
+the model that computed them, so the same sentence is only transformed once
+across clusters and runs, and vectors from other models are never returned.
+Recently used vectors are kept in memory (an LRU with limited size) and all
+vectors are stored in a SQLite database, which can be safely shared by
+several processes.
+'''
+
+import os
+import hashlib
+import logging
+import sqlite3
+import multiprocessing
+from collections import OrderedDict
+
+import numpy
+
+def sentence_key(tokens, model_fingerprint):
+    '''
+    Return the cache key of a sentence with the given tokens, transformed
+    by the model with the given fingerprint.
+    '''
+    text = model_fingerprint + u'\n' + u'\n'.join(tokens)
+    return hashlib.md5(text.encode('utf-8')).digest()
+
+class SentenceVectorCache(object):
+    '''
+    Class to store and retrieve sentence vectors. It can be shared by worker
+    processes forked after its creation; each one opens its own connection to
+    the database and hit and miss counts are shared by all of them.
+    '''
+    # maximum number of keys in a single SQL query
+    query_size = 500
+    
+    def __init__(self, filename=None, max_items=100000):
+        '''
+        :param filename: the database file. If None, only the memory tier is used.
+        :param max_items: maximum number of vectors kept in memory
+        '''
+        self.filename = filename
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self._connection = None
+        self._connection_pid = None
+        
+        # memory hits, disk hits and misses
+        self.counts = multiprocessing.Array('l', 3)
+    
+    def _get_connection(self):
+        '''
+        Return a connection to the database, opening it if needed. Forked
+        processes can't use the connection of their parent.
+        '''
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.filename, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS vectors '\
+                                     '(key BLOB PRIMARY KEY, vector BLOB)')
+            self._connection_pid = os.getpid()
+        
+        return self._connection
+    
+    def _remember(self, key, vector):
+        '''
+        Add a vector to the memory tier, discarding the least recently used
+        one if it is full.
+        '''
+        self.memory[key] = vector
+        if len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+    
+    def get_many(self, keys):
+        '''
+        Return a list with the vector stored for each key, or None for the
+        keys not in the cache.
+        '''
+        vectors = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.memory:
+                # move the vector to the end of the LRU order
+                vectors[i] = self.memory.pop(key)
+                self.memory[key] = vectors[i]
+            else:
+                missing.append(i)
+        
+        memory_hits = len(keys) - len(missing)
+        disk_hits = 0
+        if missing and self.filename is not None:
+            connection = self._get_connection()
+            positions = {keys[i]: i for i in missing}
+            missing_keys = list(positions)
+            
+            for start in range(0, len(missing_keys), self.query_size):
+                chunk = missing_keys[start:start + self.query_size]
+                query = 'SELECT key, vector FROM vectors WHERE key IN ({})'.\
+                    format(', '.join('?' * len(chunk)))
+                rows = connection.execute(query, [sqlite3.Binary(key) for key in chunk])
+                
+                for key, data in rows:
+                    key = bytes(key)
+                    vector = numpy.frombuffer(bytes(data), numpy.float32)
+                    vectors[positions[key]] = vector
+                    self._remember(key, vector)
+                    disk_hits += 1
+        
+        with self.counts.get_lock():
+            self.counts[0] += memory_hits
+            self.counts[1] += disk_hits
+            self.counts[2] += len(keys) - memory_hits - disk_hits
+        
+        return vectors
+    
+    def put_many(self, keys, vectors):
+        '''
+        Store the given vectors in the cache.
+        '''
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        for key, vector in zip(keys, vectors):
+            self._remember(key, vector)
+        
+        if self.filename is not None:
+            connection = self._get_connection()
+            with connection:
+                connection.executemany('INSERT OR IGNORE INTO vectors VALUES (?, ?)',
+                                       [(sqlite3.Binary(key), sqlite3.Binary(vector.tostring()))
+                                        for key, vector in zip(keys, vectors)])
+    
+    def stats(self):
+        '''
+        Return a dictionary with the hit and miss counts of all processes.
+        '''
+        memory_hits, disk_hits, misses = self.counts[:]
+        return {'memory_hits': memory_hits, 'disk_hits': disk_hits, 'misses': misses}
+    
+    def log_stats(self):
+        '''
+        Log the hit and miss counts.
+        '''
+        stats = self.stats()
+        total = sum(stats.values())
+        hit_rate = (stats['memory_hits'] + stats['disk_hits']) / float(max(total, 1))
+        logging.info('Vector cache: {memory_hits} memory hits, {disk_hits} disk hits, '\
+                     '{misses} misses'.format(**stats) + ' ({:.1%} hit rate)'.format(hit_rate))
@@ -15,12 +15,184 @@ import logging
 import re
 import os
 import argparse
+import itertools
 import cPickle
-import gensim
+import hashlib
+import numpy
+import math
+import time
+import scipy.sparse
 
 import rte_data
+import utils
 from config import FileAccess
 import corpusmanager
+import annindex
+import projection
+import vectorcache
+import miningstats
+
+# gensim takes a long time to import and isn't needed when mining with a bundle
+gensim = utils.LazyModule('gensim')
+
+def files_fingerprint(paths):
+    '''
+    Return a hash of the names, sizes and modification times of the given files.
+    '''
+    md5 = hashlib.md5()
+    for path in paths:
+        stat = os.stat(path)
+        description = '{}\t{}\t{!r}\n'.format(os.path.basename(path), stat.st_size, 
+                                             stat.st_mtime)
+        md5.update(description.encode('utf-8'))
+    
+    return md5.hexdigest()
+
+def unit_rows(matrix):
+    '''
+    Return the given matrix with its rows normalized to unit length. Rows 
+    with only zeros are kept unchanged.
+    '''
+    norms = numpy.sqrt((matrix ** 2).sum(1))
+    norms[norms == 0] = 1
+    return (matrix / norms[:, numpy.newaxis]).astype(numpy.float32)
+
+# reasons why a sentence can't be used as T or H in a pair, other than having
+# been used in another pair, formatted with t or h. 0 means there is none
+_rejection_reasons = (None, 'filter_out_{}', 'avoided_{}', 'min_{}_size', 'max_{}_size')
+_filtered_out = 1
+
+def _rejection_codes(sentences, sizes, avoided, filter_out, min_size, max_size):
+    '''
+    Return an array with the first reason (its position in `_rejection_reasons`)
+    why each sentence can't be used in a pair, or 0 if it can.
+    
+    :param sizes: array with the number of tokens in each sentence
+    :param avoided: boolean array indicating the sentences to avoid
+    :param filter_out: function returning True for sentences to discard
+    :param max_size: maximum number of tokens; 0 means no limit
+    '''
+    # later reasons are overwritten by the previous ones
+    codes = numpy.zeros(len(sentences), numpy.int8)
+    if max_size > 0:
+        codes[sizes > max_size] = 4
+    codes[sizes < min_size] = 3
+    codes[avoided] = 2
+    codes[numpy.array([filter_out(sentence) for sentence in sentences], 
+                      dtype=numpy.bool_)] = _filtered_out
+    return codes
+
+def _alpha_checks(overlaps, t_size, h_sizes, absolute_min_alpha, min_alpha, max_alpha):
+    '''
+    Check the content words exclusive to a T and to each of a set of H 
+    candidates, in the two ways. Return a tuple (proportions1, proportions2,
+    absolute_alphas, valid_alphas) with the proportions of exclusive words in 
+    T and in each H, and whether each candidate has enough exclusive words 
+    and all the checks pass.
+    
+    :param overlaps: array with the number of content words shared by T and 
+        each candidate
+    :param t_size: number of content words in T
+    :param h_sizes: array with the number of content words in each candidate
+    '''
+    diff1 = t_size - overlaps
+    diff2 = h_sizes - overlaps
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        proportions1 = diff1 / t_size
+        proportions2 = diff2 / h_sizes
+        absolute_alphas = (diff1 >= absolute_min_alpha) & (diff2 >= absolute_min_alpha)
+        valid_alphas = absolute_alphas & \
+                       (proportions1 >= min_alpha) & (proportions2 >= min_alpha) & \
+                       (proportions1 <= max_alpha) & (proportions2 <= max_alpha)
+    
+    return proportions1, proportions2, absolute_alphas, valid_alphas
+
+def _content_overlaps(content_words, sentences_by_word, row):
+    '''
+    Return an array with the number of content words that the sentence in the 
+    given row shares with each sentence.
+    
+    :param content_words: sparse binary CSR matrix indicating the content words
+        in each sentence
+    :param sentences_by_word: the transpose of content_words as a CSR matrix, 
+        indicating the sentences with each content word
+    '''
+    start, end = content_words.indptr[row], content_words.indptr[row + 1]
+    indptr = sentences_by_word.indptr
+    sentences = [sentences_by_word.indices[indptr[word]:indptr[word + 1]] 
+                 for word in content_words.indices[start:end]]
+    
+    # each sentence appears once for each content word it shares
+    sentences = numpy.concatenate(sentences) if sentences else numpy.zeros(0, numpy.int32)
+    return numpy.bincount(sentences, minlength=content_words.shape[0])
+
+def _count_h_rejections(stats, t_position, similarities, overlaps, content_sizes, 
+                        h_rejections, ignored, min_score, max_score, absolute_min_alpha,
+                        min_alpha, max_alpha):
+    '''
+    Count the reasons why the sentences more similar than min_score to a T
+    are rejected as H in a miningstats.MiningStats object. Each one is counted
+    once, with the reasons checked in this order: max_score, absolute alpha, 
+    min/max alpha, filter_out_h, ignored (already used), avoided and size limits.
+    '''
+    args = numpy.flatnonzero(similarities >= min_score)
+    
+    # the sentence itself is not a candidate
+    args = args[args != t_position]
+    stats.count('candidates', len(args))
+    
+    too_similar = similarities[args] >= max_score
+    stats.count('max_score', numpy.count_nonzero(too_similar))
+    args = args[~too_similar]
+    
+    _, _, absolute_alphas, valid_alphas = _alpha_checks(overlaps[args], 
+                                                        content_sizes[t_position],
+                                                        content_sizes[args], 
+                                                        absolute_min_alpha,
+                                                        min_alpha, max_alpha)
+    stats.count('absolute_alpha', numpy.count_nonzero(~absolute_alphas))
+    stats.count('min_max_alpha', numpy.count_nonzero(absolute_alphas & ~valid_alphas))
+    args = args[valid_alphas]
+    
+    rejections = h_rejections[args]
+    filtered_out = rejections == _filtered_out
+    used = ignored[args] & ~filtered_out
+    stats.count('filter_out_h', numpy.count_nonzero(filtered_out))
+    stats.count('ignored_h', numpy.count_nonzero(used))
+    
+    rejections = rejections[~filtered_out & ~used]
+    for reason in range(_filtered_out + 1, len(_rejection_reasons)):
+        stats.count(_rejection_reasons[reason].format('h'), 
+                    numpy.count_nonzero(rejections == reason))
+
+class DenseIndex(object):
+    '''
+    Similarity index over a matrix with the normalized vectors of a cluster 
+    (possibly memory mapped). It works like a gensim MatrixSimilarity, but 
+    doesn't need gensim.
+    '''
+    def __init__(self, vectors):
+        self.index = vectors
+    
+    def __getitem__(self, query):
+        '''
+        Return the cosine similarities of the query (a sparse vector in gensim
+        format) to all indexed vectors.
+        '''
+        vector = numpy.zeros(self.index.shape[1])
+        length = math.sqrt(sum(value ** 2 for _, value in query))
+        for i, value in query:
+            vector[i] = value / length
+        
+        return numpy.dot(self.index, vector.astype(self.index.dtype))
+    
+    def to_gensim(self):
+        '''
+        Return an equivalent gensim MatrixSimilarity object.
+        '''
+        index = gensim.similarities.MatrixSimilarity([], num_features=self.index.shape[1])
+        index.index = numpy.asarray(self.index)
+        return index
 
 class VectorSpaceAnalyzer(object):
     '''
@@ -33,9 +205,15 @@ class VectorSpaceAnalyzer(object):
         useful with this class.
         '''
         self.ignored_docs = set()
+        self.projection = None
+        
+        # a vectorcache.SentenceVectorCache used when computing sentence vectors
+        self.vector_cache = None
     
     def generate_model(self, corpus, data_directory, method='lsi', load_dictionary=False, 
-                       stopwords=None, num_topics=100, **corpus_manager_args):
+                       stopwords=None, num_topics=100, token_stream=False,
+                       load_token_stream=False, max_dictionary_tokens=2000000, 
+                       **corpus_manager_args):
         '''
         Generate a VSM from the given corpus and save it to the given directory.
         
@@ -45,20 +223,34 @@ class VectorSpaceAnalyzer(object):
         :param stopwords: file with stopwords (one per line)
         :param num_topics: number of VSM topics (ignored if method is hdp)
         :param load_dictionary: load a previously saved dictionary
+        :param token_stream: tokenize the corpus only once, saving it to a token
+            stream file in the data directory. All passes over the corpus 
+            (dictionary, TF-IDF and model training) read this file instead.
+        :param load_token_stream: use a token stream previously saved in the data
+            directory, without reading the corpus at all
+        :param max_dictionary_tokens: maximum number of tokens kept in memory
+            while creating the dictionary. See `create_dictionary`.
         :param corpus_manager_args: named arguments supplied to the corpus manager
             object created in this object.
         '''
-        self.cm = corpusmanager.SentenceCorpusManager(corpus, 
-                                                      metadata_directory=data_directory, 
-                                                      **corpus_manager_args)
         self.method = method
         self.num_topics = num_topics
         self.file_access = FileAccess(data_directory)
         
+        if load_token_stream:
+            self.cm = corpusmanager.TokenStreamCorpusManager(self.file_access.token_stream)
+        else:
+            self.cm = corpusmanager.SentenceCorpusManager(corpus, 
+                                                          metadata_directory=data_directory, 
+                                                          **corpus_manager_args)
+            if token_stream:
+                self.cm = corpusmanager.TokenStreamCorpusManager(self.file_access.token_stream,
+                                                                 self.cm)
+        
         if load_dictionary:
             self.token_dict = gensim.corpora.Dictionary.load(self.file_access.dictionary)
         else:
-            self.create_dictionary(stopwords)
+            self.create_dictionary(stopwords, max_dictionary_tokens)
         
         self.cm.set_yield_ids(self.token_dict)
         self.create_model()
@@ -67,6 +259,9 @@ class VectorSpaceAnalyzer(object):
             # (pretty hard to find, by the way)
             self.num_topics = self.hdp.m_lambda.shape[0]
         self.save_metadata()
+        if self.method in ('lsi', 'rp'):
+            self.export_projection()
+        self.model_fingerprint = self._compute_model_fingerprint(self.file_access)
         
     def save_metadata(self):
         '''
@@ -79,6 +274,118 @@ class VectorSpaceAnalyzer(object):
         with open(filename, 'wb') as f:
             cPickle.dump(data, f, -1)
     
+    def update_model(self, corpus, data_directory, **corpus_manager_args):
+        '''
+        Update the models saved in the given directory with the files in the 
+        corpus that are new or were modified since the models were created or 
+        last updated, according to the corpus manifest. Only these files are 
+        read.
+        
+        The document frequencies in the dictionary and the TF-IDF weights are 
+        updated, and the new sentences are folded into the LSI, LDA or HDP 
+        model (RP doesn't depend on the corpus). The vocabulary stays the same, 
+        since the models have a fixed number of terms: new words are ignored 
+        until the models are generated again. Likewise, the previous content of 
+        modified or removed files is not forgotten.
+        
+        :param corpus: directory containing corpus text files
+        :param data_directory: directory where the models were saved
+        :param corpus_manager_args: named arguments supplied to the corpus manager
+        '''
+        file_access = FileAccess(data_directory)
+        if not os.path.exists(file_access.corpus_manifest):
+            raise ValueError('There is no corpus manifest in {}; models can only be updated '\
+                             'if they were generated from a corpus directory'.format(data_directory))
+        
+        self.load_data(data_directory)
+        
+        # the manifest is saved right away with the new files, so the old one
+        # is restored if the update fails; otherwise they wouldn't be new anymore
+        old_manifest = corpusmanager.CorpusManifest(file_access.corpus_manifest)
+        
+        try:
+            self.cm = corpusmanager.SentenceCorpusManager(corpus, 
+                                                          metadata_directory=data_directory,
+                                                          **corpus_manager_args)
+            modified_files = [path for path in self.cm.changed_files
+                              if os.path.relpath(path, self.cm.directory) in old_manifest.files]
+            if modified_files or self.cm.manifest.removed_files:
+                logging.warning('{} modified and {} removed files still count in the models '\
+                                'with their old content; generate the models again to '\
+                                'discard it'.format(len(modified_files), 
+                                                    len(self.cm.manifest.removed_files)))
+            
+            self.cm.set_yield_ids(self.token_dict)
+            self.cm.set_only_changed_files()
+            try:
+                updated = self._update_with_changed_files(file_access)
+            finally:
+                # later uses of the corpus manager (such as the corpus index) 
+                # need all the files
+                self.cm.set_only_changed_files(False)
+        except:
+            old_manifest.save()
+            raise
+        
+        if not updated:
+            return
+        
+        if self.method in ('lsi', 'rp'):
+            self.export_projection()
+        self.model_fingerprint = self._compute_model_fingerprint(file_access)
+        if os.path.exists(file_access.bundle):
+            self.save_bundle()
+    
+    def _update_with_changed_files(self, file_access):
+        '''
+        Update the dictionary and the models with the files the corpus manager 
+        is set to iterate over, and then save them. Return False if there are 
+        none.
+        '''
+        if not self.cm.changed_files:
+            logging.info('No new files; nothing to update')
+            return False
+        
+        logging.info('Updating models with {} sentences from {} files'.format(
+            len(self.cm), len(self.cm.changed_files)))
+        self._update_document_frequencies(self.cm)
+        if self.method in ('lsi', 'lda'):
+            # TF-IDF weights depend only on the document frequencies
+            self.tfidf = gensim.models.TfidfModel(dictionary=self.token_dict)
+        
+        if self.method == 'lsi':
+            self.lsi.add_documents(self.tfidf[self.cm])
+        elif self.method == 'lda':
+            self.lda.update(self.cm)
+        elif self.method == 'hdp':
+            self.hdp.update(self.cm)
+        
+        # nothing is saved until all models were updated, so that the saved 
+        # files still match each other (and the manifest) if any update fails
+        self.token_dict.save(file_access.dictionary)
+        if self.method in ('lsi', 'lda'):
+            self.tfidf.save(file_access.tfidf)
+        
+        if self.method == 'lsi':
+            self.lsi.save(file_access.lsi)
+        elif self.method == 'lda':
+            self.lda.save(file_access.lda)
+        elif self.method == 'hdp':
+            self.hdp.save(file_access.hdp)
+        
+        return True
+    
+    def _update_document_frequencies(self, corpus):
+        '''
+        Add the documents in the given corpus (bags of words) to the document 
+        counts of the dictionary, without adding new tokens.
+        '''
+        for bow in corpus:
+            self.token_dict.num_docs += 1
+            self.token_dict.num_nnz += len(bow)
+            for token_id, _ in bow:
+                self.token_dict.dfs[token_id] = self.token_dict.dfs.get(token_id, 0) + 1
+    
     def create_model(self):
         '''
         Create the VSM used by this object.
@@ -101,6 +408,17 @@ class VectorSpaceAnalyzer(object):
         Transform the given bag of words in a vector space representation
         according to the method used by this object.
         '''
+        if self.projection is not None:
+            if bag_of_words == []:
+                # an empty document, which gensim would take as an empty corpus
+                return []
+            
+            is_corpus, bag_of_words = gensim.utils.is_corpus(bag_of_words)
+            if is_corpus:
+                return self._transform_in_chunks(bag_of_words)
+            
+            return gensim.matutils.full2sparse(self.projection.transform(bag_of_words))
+        
         if self.method == 'lsi':
             transformed_tfidf = self.tfidf[bag_of_words]
             return self.lsi[transformed_tfidf]
@@ -116,41 +434,184 @@ class VectorSpaceAnalyzer(object):
         else:
             raise ValueError('Unknown VSM method: {}'.format(self.method))
     
-    def create_dictionary(self, stopwords_file=None):
+    def _transform_in_chunks(self, corpus, chunk_size=10000):
+        '''
+        Yield the sparse vector space representation of each bag of words in
+        the corpus. They are transformed in batches of chunk_size, so that the
+        corpus is never loaded to memory at once.
+        '''
+        bags_of_words = iter(corpus)
+        while True:
+            chunk = list(itertools.islice(bags_of_words, chunk_size))
+            if not chunk:
+                return
+            
+            for vector in self.transform_batch(chunk):
+                yield gensim.matutils.full2sparse(vector)
+    
+    def transform_batch(self, bags_of_words):
+        '''
+        Transform the given bags of words and return a dense matrix with one 
+        row for each. With an exported projection (see `export_projection`), 
+        this is done with a single matrix product.
+        '''
+        bags_of_words = list(bags_of_words)
+        if self.projection is not None:
+            return self.projection.transform_batch(bags_of_words)
+        
+        vsm_reprs = [self.transform(bow) for bow in bags_of_words]
+        return gensim.matutils.corpus2dense(vsm_reprs, self.num_topics, len(vsm_reprs)).T
+    
+    def sentence_vectors(self, token_lists):
+        '''
+        Return a dense matrix with the vector of each of the given token lists 
+        (rows). If a vector cache is set, only the vectors not found in it are
+        computed, and then added to it.
+        '''
+        token_lists = list(token_lists)
+        if self.vector_cache is None:
+            return self.transform_batch(self.token_dict.doc2bow(tokens) 
+                                        for tokens in token_lists)
+        
+        keys = [vectorcache.sentence_key(tokens, self.model_fingerprint) 
+                for tokens in token_lists]
+        cached = self.vector_cache.get_many(keys)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        
+        vectors = numpy.zeros((len(token_lists), self.num_topics), numpy.float32)
+        if missing:
+            new_vectors = self.transform_batch(self.token_dict.doc2bow(token_lists[i])
+                                               for i in missing)
+            vectors[missing] = new_vectors
+            self.vector_cache.put_many([keys[i] for i in missing], new_vectors)
+        
+        for i, vector in enumerate(cached):
+            if vector is not None:
+                vectors[i] = vector
+        
+        return vectors
+    
+    def _projection_arrays(self):
+        '''
+        Return a tuple (tokens, matrix, idfs) describing the transformation
+        done by the lsi or rp model. See `projection.save_projection`.
+        '''
+        if self.projection is not None:
+            return (self.projection.vocabulary.id2token, self.projection.matrix, 
+                    self.projection.idfs)
+        
+        num_terms = len(self.token_dict)
+        tokens = [self.token_dict[i] for i in range(num_terms)]
+        
+        if self.method == 'lsi':
+            idfs = numpy.zeros(num_terms)
+            for term_id, idf in self.tfidf.idfs.items():
+                idfs[term_id] = idf
+            
+            # gensim doesn't scale LSI vectors by the singular values
+            matrix = self.lsi.projection.u[:, :self.num_topics].T
+        elif self.method == 'rp':
+            idfs = None
+            matrix = self.rp.projection / numpy.sqrt(self.num_topics)
+        else:
+            raise ValueError('Projections can only be exported for lsi and rp')
+        
+        return tokens, matrix, idfs
+    
+    def export_projection(self):
+        '''
+        Save the vocabulary, IDF weights and projection matrix of the lsi or
+        rp model as plain arrays, which can be used without gensim by 
+        `projection.DenseProjection`.
+        '''
+        tokens, matrix, idfs = self._projection_arrays()
+        projection.save_projection(self.file_access.projection, tokens, matrix, idfs)
+    
+    def save_bundle(self, filename=None):
         '''
-        Try to load the dictionary if the given filename is not None.
-        If it is, create from the corpus.
+        Save everything needed to mine candidate pairs (the metadata, the 
+        vocabulary and the projection) in a single file, which loads much 
+        faster than the gensim models. Only possible with lsi and rp.
+        
+        :param filename: default is the bundle file in the data directory
+        '''
+        if filename is None:
+            filename = self.file_access.bundle
+        
+        tokens, matrix, idfs = self._projection_arrays()
+        projection.save_projection(filename, tokens, matrix, idfs, method=self.method,
+                                   num_topics=self.num_topics,
+                                   model_fingerprint=self.model_fingerprint)
+    
+    def load_bundle(self, filename):
+        '''
+        Load a bundle saved by `save_bundle`. Sentences are transformed with
+        the bundled projection and gensim is not imported.
+        '''
+        self.projection = projection.DenseProjection(filename)
+        self.token_dict = self.projection.vocabulary
+        self.method = self.projection.metadata['method']
+        self.num_topics = int(self.projection.metadata['num_topics'])
+        self.model_fingerprint = str(self.projection.metadata['model_fingerprint'])
+        self.file_access = FileAccess(os.path.dirname(filename))
+    
+    def create_dictionary(self, stopwords_file=None, max_tokens=2000000, batch_size=10000):
+        '''
+        Create the token dictionary from the corpus, without stopwords, 
+        punctuation and very common or rare tokens.
         
-        :param filename: name of the file containing the saved dictionary.
         :param stopwords_file: name of the file containing stopwords
-        :param minimum_df: the minimum document frequency a token must have in 
-            order to be included in the dictionary.
+        :param max_tokens: maximum number of tokens kept in memory while 
+            counting. When there are more, the ones with the lowest document
+            frequencies are discarded, and if they appear again they are 
+            counted from zero. The dictionary is the same as without pruning
+            unless a token discarded this way would end with at least the 
+            minimum frequency (20); with a cap much larger than the final 
+            dictionary (50000 tokens), those are rare long tail tokens.
+        :param batch_size: number of sentences added to the dictionary at a time
         '''
         # start it empty and fill it iteratively
         self.token_dict = gensim.corpora.Dictionary()
         
-        logging.info('Creating token dictionary')
-        for document in self.cm:
-            self.token_dict.add_documents([document])
-        
+        excluded = set()
         if stopwords_file is not None:
             # load all stopwords from the given file
             with open(stopwords_file, 'rb') as f:
                 text = f.read().decode('utf-8')
-            stopwords = text.split('\n')
+            excluded.update(text.split('\n'))
+        
+        # stopwords and punctuation are removed from each sentence before it
+        # is counted, so they don't take memory. the sentences are still 
+        # counted as documents, even if they end up empty
+        punctuation = re.compile('\W+$')
+        known_tokens = set()
+        
+        def content_tokens(document):
+            tokens = []
+            for token in document:
+                if token not in known_tokens:
+                    if token in excluded or punctuation.match(token):
+                        continue
+                    
+                    known_tokens.add(token)
+                    if len(known_tokens) > max_tokens:
+                        # cache of tokens already checked; it's cheaper to 
+                        # forget it than to keep it in sync with pruning
+                        known_tokens.clear()
+                
+                tokens.append(token)
             
-            # check which words appear in the dictionary and remove them
-            stop_ids = [self.token_dict.token2id[stopword] 
-                        for stopword in stopwords 
-                        if stopword in self.token_dict.token2id]
-            self.token_dict.filter_tokens(stop_ids)
+            return tokens
         
-        # remove punctuation
-        punct_ids = [self.token_dict.token2id[token] 
-                     for token in self.token_dict.token2id 
-                     if re.match('\W+$', token)]
+        logging.info('Creating token dictionary')
+        batch = []
+        for document in self.cm:
+            batch.append(content_tokens(document))
+            if len(batch) == batch_size:
+                self._add_to_dictionary(batch, max_tokens)
+                batch = []
         
-        self.token_dict.filter_tokens(punct_ids)
+        self._add_to_dictionary(batch, max_tokens)
         
         # remove common and rare tokens (gensim by default filters out words 
         # appearing in less than 5 or more than 50% of the documents)
@@ -162,16 +623,64 @@ class VectorSpaceAnalyzer(object):
         filename = self.file_access.dictionary
         self.token_dict.save(filename)
     
-    def load_data(self, directory):
+    def _add_to_dictionary(self, documents, max_tokens):
+        '''
+        Add the given documents to the token dictionary, and prune it if it 
+        has more than max_tokens tokens.
+        '''
+        self.token_dict.add_documents(documents, prune_at=None)
+        if len(self.token_dict) > max_tokens:
+            logging.info('Pruning the dictionary from {} to {} tokens'.format(
+                len(self.token_dict), max_tokens))
+            self.token_dict.filter_extremes(no_below=1, no_above=1.0, keep_n=max_tokens)
+    
+    def load_data(self, directory, fast_transform=False, use_bundle=False):
         '''
         Load the models from the given directory.
+        
+        :param fast_transform: with the lsi or rp methods, load the exported
+            projection instead of the gensim models, which is much faster to 
+            load and to apply in batches. Results match gensim's up to floating 
+            point precision. The projection is exported if it doesn't exist yet.
+        :param use_bundle: load only the bundle file (see `save_bundle`), which
+            is the fastest option. It is created if it doesn't exist or was 
+            saved from other models. If the model files aren't in the directory, 
+            the bundle is used as it is. Implies `fast_transform`.
         '''
         file_access = FileAccess(directory)
+        if use_bundle:
+            if os.path.exists(file_access.bundle):
+                self.load_bundle(file_access.bundle)
+                model_files = self._model_files(file_access)
+                if not all(os.path.exists(path) for path in model_files):
+                    # the bundle can be used without the models it was saved from,
+                    # but then it can't be checked against them
+                    return
+                
+                if self.model_fingerprint == files_fingerprint(model_files):
+                    return
+                
+                self.projection = None
+            
+            self.load_data(directory, fast_transform=True)
+            if self.method in ('lsi', 'rp'):
+                self.save_bundle()
+            else:
+                logging.warning('Bundles can only be used with lsi and rp models')
+            return
+        
         with open(file_access.vsa_metadata, 'rb') as f:
             metadata = cPickle.load(f)
         self.__dict__.update(metadata)
         
         self.token_dict = gensim.corpora.Dictionary.load(file_access.dictionary)
+        self.file_access = file_access
+        self.model_fingerprint = self._compute_model_fingerprint(file_access)
+        
+        if fast_transform and self.method in ('lsi', 'rp') and \
+                os.path.exists(file_access.projection):
+            self.projection = projection.DenseProjection(file_access.projection)
+            return
         
         if self.method == 'lsi':
             self.tfidf = gensim.models.TfidfModel.load(file_access.tfidf)
@@ -183,6 +692,27 @@ class VectorSpaceAnalyzer(object):
             self.rp = gensim.models.RpModel.load(file_access.rp)
         elif self.method == 'hdp':
             self.hdp = gensim.models.HdpModel.load(file_access.hdp)
+        
+        if fast_transform and self.method in ('lsi', 'rp'):
+            self.export_projection()
+            self.projection = projection.DenseProjection(file_access.projection)
+    
+    def _model_files(self, file_access):
+        '''
+        Return the paths of the saved model files used by this object.
+        '''
+        model_files = {'lsi': [file_access.tfidf, file_access.lsi],
+                       'lda': [file_access.tfidf, file_access.lda],
+                       'rp': [file_access.rp],
+                       'hdp': [file_access.hdp]}
+        return [file_access.vsa_metadata, file_access.dictionary] + model_files[self.method]
+    
+    def _compute_model_fingerprint(self, file_access):
+        '''
+        Return a hash identifying the saved model files used by this object.
+        Indices created with other models are recreated.
+        '''
+        return files_fingerprint(self._model_files(file_access))
     
     # TODO: organize the following model creation functions avoiding repeated code
     # (I'm unwilling to use setattr and getattr though) 
@@ -230,16 +760,36 @@ class VectorSpaceAnalyzer(object):
         filename = self.file_access.lda
         self.lda.save(filename)
     
-    def create_index(self):
+    def create_index(self, output_directory=None, shard_size=32768):
         '''
-        Create a similarity index to be used with the corpus.
+        Create a similarity index to be used with the corpus. The index is split
+        in shards of up to `shard_size` documents, each one saved to a separate
+        file, so that the whole index doesn't need to fit in memory.
+        
+        :param output_directory: directory where the index and its shards are
+            saved. Default is the data directory.
         '''
+        if output_directory is None:
+            file_access = self.file_access
+        else:
+            file_access = FileAccess(output_directory)
+        
         vsm_repr = self.transform(self.cm)
-        self.index = gensim.similarities.Similarity('shard', 
-                                                    self.lsi[vsm_repr],
-                                                    self.num_topics)
-        filename = self.file_access.index
-        self.index.save(filename)
+        self.index = gensim.similarities.Similarity(file_access.index_shards, 
+                                                    vsm_repr,
+                                                    self.num_topics,
+                                                    shardsize=shard_size)
+        self.index.save(file_access.index)
+    
+    def load_index(self, directory=None):
+        '''
+        Load the similarity index created by `create_index`.
+        
+        :param directory: the directory where the index was saved. Default is 
+            the data directory.
+        '''
+        file_access = self.file_access if directory is None else FileAccess(directory)
+        self.index = gensim.similarities.Similarity.load(file_access.index)
     
     def find_similar_documents(self, tokens, number=10, return_scores=True):
         '''
@@ -248,46 +798,290 @@ class VectorSpaceAnalyzer(object):
         
         :param return_scores: if True, return instead a tuple (ids, similarities)
         '''
-        # create a bag of words from the document
-        bow = self.token_dict.doc2bow(tokens)
-        vsm_repr = self.transform(bow)
-        similarities = self.index[vsm_repr]
+        return self.find_similar_documents_batch([tokens], number, return_scores)[0]
+    
+    def find_similar_documents_batch(self, token_lists, number=10, return_scores=True):
+        '''
+        Find the most similar documents to each of the ones represented by the
+        given token lists. Return a list with the result for each document in 
+        the same format as `find_similar_documents`.
+        
+        All queries are compared to each shard of the index at once, and only the
+        best `number` documents in each shard are kept and merged. As in
+        `find_similar_documents`, the most similar document to each query is 
+        skipped, since it is the document itself, and documents in `ignored_docs`
+        are never returned.
+        '''
+        bows = [self.token_dict.doc2bow(tokens) for tokens in token_lists]
+        queries = unit_rows(self.transform_batch(bows))
         
-        # the similarities array contains the simliraty value for each document
-        # we pick the indices in the order that would sort it
-        indices = similarities.argsort()
+        ignored = numpy.array(sorted(self.ignored_docs), dtype=numpy.int64)
+        rows = numpy.arange(len(queries))[:, numpy.newaxis]
         
-        # [::-1] reverses the order, so we have the greatest values first
-        indices = indices[::-1]
+        # the best document of each query (the query itself) and the best
+        # `number + 1` ones not ignored, merged shard by shard
+        first_ids = numpy.zeros(len(queries), numpy.int64)
+        first_scores = numpy.empty(len(queries))
+        first_scores.fill(-numpy.inf)
+        best_ids = numpy.zeros((len(queries), 0), numpy.int64)
+        best_scores = numpy.zeros((len(queries), 0))
         
-        top_indices = []
-        # exclude the first one because it is the compared document itself
-        for index in indices[1:]:
-            if index in self.ignored_docs:
-                continue
+        self.index.close_shard()
+        offset = 0
+        for shard in self.index.shards:
+            shard_index = shard.get_index().index
+            similarities = numpy.asarray(shard_index.dot(queries.T)).T
+            shard_ids = numpy.arange(offset, offset + similarities.shape[1])
+            offset += similarities.shape[1]
             
-            top_indices.append(index)
+            # in case of ties, the last document is taken as the query itself, 
+            # as done by a reversed argsort
+            shard_first = similarities.shape[1] - 1 - similarities[:, ::-1].argmax(1)
+            is_better = similarities[rows[:, 0], shard_first] >= first_scores
+            first_ids[is_better] = shard_ids[shard_first[is_better]]
+            first_scores[is_better] = similarities[rows[is_better, 0], shard_first[is_better]]
             
-            if len(top_indices) == number:
-                break
+            if len(ignored):
+                similarities[:, numpy.in1d(shard_ids, ignored)] = -numpy.inf
+            
+            # partial selection of the best documents in the shard
+            keep = min(number + 1, similarities.shape[1])
+            top = numpy.argpartition(-similarities, keep - 1, 1)[:, :keep]
+            best_ids = numpy.hstack([best_ids, shard_ids[top]])
+            best_scores = numpy.hstack([best_scores, similarities[rows, top]])
+            
+            if best_ids.shape[1] > number + 1:
+                top = numpy.argpartition(-best_scores, number, 1)[:, :number + 1]
+                best_ids = best_ids[rows, top]
+                best_scores = best_scores[rows, top]
+        
+        results = []
+        for i in range(len(queries)):
+            order = numpy.argsort(-best_scores[i], kind='mergesort')
+            valid = [j for j in order 
+                     if best_ids[i, j] != first_ids[i] and best_scores[i, j] > -numpy.inf]
+            top_indices = best_ids[i, valid[:number]].tolist()
+            
+            if return_scores:
+                results.append((top_indices, best_scores[i, valid[:number]]))
+            else:
+                results.append(top_indices)
+        
+        return results
+    
+    def cluster_fingerprint(self, cluster_dir, pre_tokenized=False, 
+                            near_duplicate_threshold=None):
+        '''
+        Return a dictionary identifying the cluster files and the model used
+        to index them.
+        '''
+        extensions = ('.txt', '.token') if pre_tokenized else ('.txt',)
+        cluster_dir = unicode(cluster_dir)
+        paths = [os.path.join(cluster_dir, filename)
+                 for filename in sorted(os.listdir(cluster_dir))
+                 if filename.endswith(extensions)]
+        
+        fingerprint = {'files': files_fingerprint(paths), 
+                       'pre_tokenized': pre_tokenized,
+                       'model': self.model_fingerprint}
+        
+        # only included when used, so that older fingerprints remain valid
+        if near_duplicate_threshold is not None:
+            fingerprint['near_duplicate_threshold'] = near_duplicate_threshold
+        
+        return fingerprint
+    
+    def _cluster_index_path(self, cluster_dir, index_format='npy'):
+        '''
+        Return the path to the index file of the cluster in the given format.
+        
+        :param index_format: 'npy' for a raw matrix with the normalized vectors
+            of all sentences (which can be memory mapped) or 'pickle' for a
+            pickled gensim MatrixSimilarity object
+        '''
+        extensions = {'npy': 'npy', 'pickle': 'dat'}
+        index_filename = 'index-{}-{}.{}'.format(self.method, self.num_topics, 
+                                                 extensions[index_format])
+        return os.path.join(cluster_dir, index_filename)
+    
+    def cluster_index_is_current(self, cluster_dir, pre_tokenized=False, index_format='npy',
+                                 near_duplicate_threshold=None):
+        '''
+        Return True if the cluster in the given directory has an index in the 
+        given format created from its current files and with the current model.
+        '''
+        fingerprint_filename = 'index-{}-{}.fingerprint'.format(self.method, self.num_topics)
+        fingerprint_path = os.path.join(cluster_dir, fingerprint_filename)
+        
+        if not os.path.exists(self._cluster_index_path(cluster_dir, index_format)) or \
+                not os.path.exists(fingerprint_path):
+            return False
+        
+        with open(fingerprint_path, 'rb') as f:
+            saved_fingerprint = cPickle.load(f)
+        
+        return saved_fingerprint == self.cluster_fingerprint(cluster_dir, pre_tokenized,
+                                                             near_duplicate_threshold)
+    
+    def create_index_for_cluster(self, cluster_dir, pre_tokenized=False, index_format='npy',
+                                 near_duplicate_threshold=None):
+        '''
+        Create an index file for the cluster in the given directory, along with
+        a fingerprint of the files and model used to create it. An index in the
+        other format is removed. Return the number of indexed sentences.
+        
+        :param index_format: 'npy' (default) or 'pickle'. See `_cluster_index_path`.
+        :param near_duplicate_threshold: Jaccard threshold to remove near-duplicate
+            sentences before indexing. The same value must be used when mining.
+        '''
+        fingerprint = self.cluster_fingerprint(cluster_dir, pre_tokenized, 
+                                               near_duplicate_threshold)
+        scm = corpusmanager.InMemorySentenceCorpusManager(cluster_dir, pre_tokenized,
+                                                          near_duplicate_threshold)
+        index = self._create_cluster_index(scm)
+        
+        # an index in the other format would be stale, and the npy format is 
+        # preferred when loading
+        for other_format in ('npy', 'pickle'):
+            other_path = self._cluster_index_path(cluster_dir, other_format)
+            if other_format != index_format and os.path.exists(other_path):
+                os.remove(other_path)
         
-        if return_scores:
-            return (top_indices, similarities[top_indices])
+        path = self._cluster_index_path(cluster_dir, index_format)
+        if index_format == 'npy':
+            numpy.save(path, index.index)
         else:
-            return top_indices
+            index.to_gensim().save(path)
+        
+        # the fingerprint is only written after the index is complete
+        fingerprint_filename = 'index-{}-{}.fingerprint'.format(self.method, self.num_topics)
+        path = os.path.join(cluster_dir, fingerprint_filename)
+        with open(path, 'wb') as f:
+            cPickle.dump(fingerprint, f, -1)
+        
+        return len(scm)
     
-    def create_index_for_cluster(self, cluster_dir, pre_tokenized=False):
+    def _create_cluster_index(self, scm):
         '''
-        Create a gensim index file for the cluster in the given directory.
+        Create a DenseIndex object indexing the sentences in the given 
+        corpus manager.
         '''
-        scm = corpusmanager.InMemorySentenceCorpusManager(cluster_dir, pre_tokenized)
+        if self.projection is not None or self.vector_cache is not None:
+            return DenseIndex(unit_rows(self.sentence_vectors(scm)))
+        
         scm.set_yield_ids(self.token_dict)
         vsm_repr = self.transform(scm)
         index = gensim.similarities.MatrixSimilarity(vsm_repr, num_features=self.num_topics)
+        scm.set_yield_tokens()
+        
+        return DenseIndex(index.index)
+    
+    def compute_cluster_vectors(self, cluster_dir, pre_tokenized=False, 
+                                near_duplicate_threshold=None):
+        '''
+        Return a tuple (vectors, hashes) for the cluster in the given directory.
+        vectors is a matrix with the normalized vector of each sentence and hashes
+        is an array with the hash of each sentence (see `utils.sentence_hash`).
+        '''
+        scm = corpusmanager.InMemorySentenceCorpusManager(cluster_dir, pre_tokenized,
+                                                          near_duplicate_threshold)
+        index = self._create_cluster_index(scm)
+        hashes = numpy.array([utils.sentence_hash(sentence) for sentence in scm.sentences],
+                             dtype=numpy.uint64)
+        
+        return index.index, hashes
+    
+    def _store_cluster_matches_model(self, vector_store, cluster):
+        '''
+        Return whether the vectors of the cluster in the vector store were 
+        created with the model used by this object.
+        '''
+        fingerprint = vector_store.get_fingerprint(cluster)
+        return vector_store.num_features == self.num_topics and \
+            fingerprint is not None and fingerprint['model'] == self.model_fingerprint
+    
+    def vector_store_matches_model(self, vector_store):
+        '''
+        Return whether all the vectors in the vector store were created with
+        the model used by this object.
+        '''
+        return all(self._store_cluster_matches_model(vector_store, cluster)
+                   for cluster in vector_store.clusters)
+    
+    def load_cluster_index_from_store(self, vector_store, cluster_dir, scm):
+        '''
+        Return a DenseIndex object with the vectors of the given cluster 
+        taken from the vector store, without copying them. Return None if the
+        store doesn't have the cluster, has different sentences for it or
+        was created with another model.
+        
+        :param vector_store: a vectorstore.ClusterVectorStore object
+        :param scm: corpus manager with the cluster sentences
+        '''
+        cluster = os.path.basename(os.path.normpath(cluster_dir))
+        if cluster not in vector_store:
+            return None
+        
+        if not self._store_cluster_matches_model(vector_store, cluster):
+            logging.warn('Vectors of cluster {} in the vector store were created with '\
+                         'another model'.format(cluster))
+            return None
+        
+        hashes = [utils.sentence_hash(sentence) for sentence in scm.sentences]
+        if not numpy.array_equal(vector_store.get_hashes(cluster), hashes):
+            logging.warn('Sentences of cluster {} differ from the vector store'.format(cluster))
+            return None
+        
+        return DenseIndex(vector_store.get_vectors(cluster))
+    
+    def load_cluster_index(self, cluster_dir):
+        '''
+        Load the index of the cluster in the given directory and return it as a 
+        DenseIndex object, or None if the cluster was not indexed.
+        
+        Indices in the npy format are memory mapped, so loading them costs almost 
+        nothing and processes reading the same index share the page cache.
+        '''
+        path = self._cluster_index_path(cluster_dir, 'npy')
+        if os.path.exists(path):
+            return DenseIndex(numpy.load(path, mmap_mode='r'))
+        
+        path = self._cluster_index_path(cluster_dir, 'pickle')
+        if os.path.exists(path):
+            return DenseIndex(gensim.similarities.MatrixSimilarity.load(path).index)
+        
+        return None
+    
+    def convert_cluster_index(self, cluster_dir):
+        '''
+        Convert the pickled index of the cluster in the given directory to the
+        npy format. The pickled file is kept. Return True if there was an index
+        to convert.
+        '''
+        path = self._cluster_index_path(cluster_dir, 'pickle')
+        if not os.path.exists(path):
+            return False
+        
+        index = gensim.similarities.MatrixSimilarity.load(path)
+        numpy.save(self._cluster_index_path(cluster_dir, 'npy'), index.index)
+        return True
+    
+    def _content_word_matrix(self, token_lists):
+        '''
+        Return a sparse binary matrix with one row for each token list, indicating
+        which content words (tokens in the dictionary) appear in it.
+        '''
+        token2id = self.token_dict.token2id
+        rows = []
+        columns = []
+        for i, tokens in enumerate(token_lists):
+            ids = set(token2id[token] for token in tokens if token in token2id)
+            rows.extend([i] * len(ids))
+            columns.extend(ids)
         
-        index_filename = 'index-{}-{}.dat'.format(self.method, self.num_topics)
-        path = os.path.join(cluster_dir, index_filename)
-        index.save(path)
+        data = numpy.ones(len(rows), dtype=numpy.int32)
+        shape = (len(token_lists), len(token2id))
+        return scipy.sparse.csr_matrix((data, (rows, columns)), shape=shape)
     
     def find_rte_candidates_in_cluster(self, corpus_dir, pre_tokenized=False, 
                                        min_score=0.8, num_pairs=0,
@@ -298,7 +1092,9 @@ class VectorSpaceAnalyzer(object):
                                        max_t_size=0, max_h_size=0,
                                        filter_out_t=lambda _: False,
                                        filter_out_h=lambda _: False,
-                                       avoid_sentences=None):
+                                       avoid_sentences=None, batch_similarity=False,
+                                       vector_store=None, near_duplicate_threshold=None,
+                                       stats=None):
         '''
         Find and return RTE candidates within the given documents.
         
@@ -320,116 +1116,398 @@ class VectorSpaceAnalyzer(object):
         :param filter_out_t: customized function to filter out T sentences 
             (should return True if the sentence should be discarded)
         :param filter_out_h: same as filter_out_t, but for H
-        :param avoid_sentences: list of sentences that should be avoided
+        :param avoid_sentences: sentences that should be avoided. It can be a list
+            or any object supporting `in`, such as an `avoidset.HashedSentenceSet`
+        :param batch_similarity: compute the similarities between all sentences
+            in the cluster with a single matrix product, instead of querying the
+            index once for each sentence. It needs memory proportional to the
+            squared number of sentences.
+        :param vector_store: a vectorstore.ClusterVectorStore object. If given 
+            and it contains the cluster, sentence vectors are read from it.
+        :param near_duplicate_threshold: if given, sentences that are near-duplicates
+            of others (with at least this Jaccard similarity) are removed before
+            mining. See `corpusmanager.InMemorySentenceCorpusManager`.
+        :param stats: a miningstats.MiningStats object. If given, the time spent
+            in each stage and the number of sentences and candidates rejected
+            for each reason are added to it.
         '''
-        scm = corpusmanager.InMemorySentenceCorpusManager(corpus_dir, pre_tokenized)
+        count_rejections = stats is not None
+        if stats is None:
+            stats = miningstats.MiningStats()
+        
+        start_time = time.time()
+        scm = corpusmanager.InMemorySentenceCorpusManager(corpus_dir, pre_tokenized,
+                                                          near_duplicate_threshold)
         scm.set_yield_tokens()
+        cluster_tokens = list(scm)
+        stats.add_time('corpus', time.time() - start_time)
+        stats.count('sentences', len(cluster_tokens))
         
-        try:
-            index_filename = 'index-{}-{}.dat'.format(self.method, self.num_topics)
-            path = os.path.join(corpus_dir, index_filename)
-            index = gensim.similarities.MatrixSimilarity.load(path)
-        except:
+        start_time = time.time()
+        index = None
+        if vector_store is not None:
+            index = self.load_cluster_index_from_store(vector_store, corpus_dir, scm)
+        
+        if index is None:
+            index = self.load_cluster_index(corpus_dir)
+            if index is not None and index.index.shape[0] != len(scm):
+                # e.g., the index was created with a different near-duplicate threshold
+                logging.warn('Index of cluster {} has {} sentences instead of {}; '\
+                             'ignoring it'.format(corpus_dir, index.index.shape[0], len(scm)))
+                index = None
+        
+        if index is None:
             logging.warn('Index was not generated. If you intend to perform multiple experiments'\
                          'on this cluster, consider indexing it first with the create_index method.')
-            vsm_repr = self.transform(scm)
-            index = gensim.similarities.MatrixSimilarity(vsm_repr, num_features=self.num_topics)
+            index = self._create_cluster_index(scm)
+        stats.add_time('index', time.time() - start_time)
         
-        # sentences already used to create pairs are ignored afterwards, in order 
-        # to allow more variability
-        ignored_sents = set()
         candidate_pairs = []
+        if avoid_sentences is None:
+            avoid_sentences = frozenset()
+        elif isinstance(avoid_sentences, list):
+            avoid_sentences = set(avoid_sentences)
         
-        if avoid_sentences is not None:
-            ignored_sents.update(avoid_sentences)
-                
-        for i, base_tokens in enumerate(scm):
-            base_sent = scm[i]
-            if filter_out_t(base_sent):
-                # drop sentences without ending punctuation
-                # this filters out titles and image subtitles
+        if batch_similarity:
+            # the index rows are the normalized vectors of the cluster sentences,
+            # so this has the similarities of every sentence to all others
+            with stats.timer('similarity'):
+                similarity_matrix = numpy.dot(index.index, index.index.T)
+        
+        if (self.vector_cache is not None or self.projection is not None) and \
+                not batch_similarity:
+            # with a cache, the vectors were probably computed when indexing
+            with stats.timer('transform'):
+                query_vectors = unit_rows(self.sentence_vectors(cluster_tokens))
+        else:
+            query_vectors = None
+        
+        # content words are the tokens except for stopwords (i.e., the ones in 
+        # the dictionary). the number of content words each T shares with the 
+        # other sentences is only computed when needed, since a matrix with all 
+        # pairs of sentences may take quadratic memory
+        start_time = time.time()
+        content_words = self._content_word_matrix(cluster_tokens)
+        content_sizes = numpy.asarray(content_words.sum(1), dtype=numpy.float64).ravel()
+        sentences_by_word = content_words.T.tocsr()
+        
+        # whether each sentence can be used as T or H doesn't change while mining,
+        # so it is checked only once. sentences already used to create pairs are 
+        # ignored afterwards, in order to allow more variability
+        sentences = [scm[i] for i in range(len(scm))]
+        sizes = numpy.array([len(tokens) for tokens in cluster_tokens], dtype=numpy.int64)
+        avoided = numpy.array([sentence in avoid_sentences for sentence in sentences], 
+                              dtype=numpy.bool_)
+        t_rejections = _rejection_codes(sentences, sizes, avoided, filter_out_t, 
+                                        min_t_size, max_t_size)
+        h_rejections = _rejection_codes(sentences, sizes, avoided, filter_out_h, 
+                                        min_h_size, max_h_size)
+        valid_h = h_rejections == 0
+        ignored = numpy.zeros(len(sentences), numpy.bool_)
+        
+        # time spent computing similarities and transforming sentences inside 
+        # the loop, which is not filtering
+        query_time = 0.0
+        
+        for i, base_tokens in enumerate(cluster_tokens):
+            # sentences filtered out are counted before the ignored ones, and 
+            # the other rejection reasons after them. this filters out titles 
+            # and image subtitles (without ending punctuation) and very short 
+            # or long sentences
+            reason = t_rejections[i]
+            if reason == _filtered_out or (reason and not ignored[i]):
+                stats.count(_rejection_reasons[reason].format('t'))
                 continue
             
-            if base_sent in ignored_sents:
+            if ignored[i]:
+                stats.count('ignored_t')
                 continue
             
-            # this set actually contains the tokens except for stopwords
-            base_content_words = set(token
-                                     for token in base_tokens
-                                     if token in self.token_dict.token2id)
+            stats.count('queries')
+            query_start = time.time()
+            if batch_similarity:
+                similarities = similarity_matrix[i]
+            elif query_vectors is not None:
+                similarities = numpy.dot(index.index, query_vectors[i])
+            else:
+                bow = self.token_dict.doc2bow(base_tokens)
+                vsm_repr = self.transform(bow)
+                transform_time = time.time() - query_start
+                stats.add_time('transform', transform_time)
+                query_time += transform_time
+                query_start = time.time()
+                similarities = index[vsm_repr]
+            
+            similarity_time = time.time() - query_start
+            stats.add_time('similarity', similarity_time)
+            query_time += similarity_time
+            
+            # too similar sentences are essentially the same. the content words
+            # are only checked for the candidates that pass all other checks
+            candidate_args = numpy.flatnonzero((similarities >= min_score) & 
+                                               (similarities < max_score) & valid_h & ~ignored)
+            if count_rejections or len(candidate_args):
+                overlaps = _content_overlaps(content_words, sentences_by_word, i)
             
-            if len(base_tokens) < min_t_size:
-                # discard very short sentences
+            if count_rejections:
+                _count_h_rejections(stats, i, similarities, overlaps, content_sizes, 
+                                    h_rejections, ignored, min_score, max_score, 
+                                    absolute_min_alpha, min_alpha, max_alpha)
+            
+            if len(candidate_args) == 0:
                 continue
             
-            if max_t_size > 0 and len(base_tokens) > max_t_size:
-                # discard long sentences (considering stop words)
+            proportions1, proportions2, _, valid_alphas = \
+                _alpha_checks(overlaps[candidate_args], content_sizes[i], 
+                              content_sizes[candidate_args], absolute_min_alpha, 
+                              min_alpha, max_alpha)
+            candidate_args = candidate_args[valid_alphas]
+            if len(candidate_args) == 0:
                 continue
             
-            bow = self.token_dict.doc2bow(base_tokens)
-            vsm_repr = self.transform(bow)
-            similarities = index[vsm_repr]
+            # the most similar candidate is the H
+            candidate_similarities = similarities[candidate_args]
+            tied_args = candidate_args[candidate_similarities == candidate_similarities.max()]
+            if len(tied_args) == 1:
+                arg = tied_args[0]
+            else:
+                # break ties in the order of a reverse sort of all sentences
+                # above the minimum score, so that the choice doesn't depend 
+                # on which of them are eligible
+                all_args = numpy.flatnonzero(similarities >= min_score)
+                all_valid_alphas = _alpha_checks(overlaps[all_args], content_sizes[i],
+                                                 content_sizes[all_args], absolute_min_alpha,
+                                                 min_alpha, max_alpha)[3]
+                all_args = all_args[all_valid_alphas]
+                sorted_args = all_args[similarities[all_args].argsort()[::-1]]
+                tied_args = set(tied_args.tolist())
+                arg = next(j for j in sorted_args if j in tied_args)
             
-            # get the indices of the sentences with highest similarity
-            # [::-1] revereses the order
-            similarity_args = similarities.argsort()[::-1]
+            similarity = similarities[arg]
+            position = candidate_args.searchsorted(arg)
+            proportion1 = float(proportions1[valid_alphas][position])
+            proportion2 = float(proportions2[valid_alphas][position])
+            pair = rte_data.Pair(sentences[i], sentences[arg], similarity=str(similarity),
+                                 alpha1=str(proportion1), alpha2=str(proportion2))
+            pair.set_t_attributes(sentence=str(i))
+            pair.set_h_attributes(sentence=str(arg))
+            candidate_pairs.append(pair)
+            stats.count('pairs')
             
-            for arg in similarity_args:
-                similarity = similarities[arg]
-                if similarity < min_score:
-                    # too dissimilar. since similarities are sorted, next ones will only be worse
-                    break
-                
-                if similarity >= max_score:
-                    # essentially the same sentence
-                    continue
-                
-                other_sent = scm[arg]
-                other_tokens = scm.get_tokenized_sentence(arg)
-                if filter_out_h(other_sent):
-                    continue
-                if other_sent in ignored_sents:
-                    continue
-                 
-                if len(other_tokens) < min_h_size:
-                    continue
-                
-                if max_h_size > 0 and len(other_tokens) > max_h_size:
-                    # discard long sentences (considering stop words)
-                    continue
-                 
-                other_sent_content_words = set(token
-                                               for token in other_tokens
-                                               if token in self.token_dict.token2id)
-                
-                # check the difference in the two ways
-                diff1 = base_content_words - other_sent_content_words
-                diff2 = other_sent_content_words - base_content_words
-                if len(diff1) < absolute_min_alpha or len(diff2) < absolute_min_alpha:
-                    continue
-                 
-                proportion1 = len(diff1) / float(len(base_content_words))
-                proportion2 = len(diff2) / float(len(other_sent_content_words))
-                if proportion1 < min_alpha or proportion2 < min_alpha:
-                    continue
-                
-                if proportion1 > max_alpha or proportion2 > max_alpha:
+            if len(candidate_pairs) == num_pairs:
+                break
+            
+            # avoid using more than one H for the same T
+            ignored[i] = ignored[arg] = True
+        
+        stats.add_time('filtering', time.time() - start_time - query_time)
+        return candidate_pairs
+    
+    def _load_store_cluster(self, vector_store, clusters_dir, cluster, pre_tokenized=False,
+                            near_duplicate_threshold=None):
+        '''
+        Load the sentences of a cluster in the vector store. Return the corpus
+        manager, or None if the sentences differ from the ones in the store.
+        '''
+        cluster_dir = os.path.join(clusters_dir, cluster)
+        scm = corpusmanager.InMemorySentenceCorpusManager(cluster_dir, pre_tokenized,
+                                                          near_duplicate_threshold)
+        hashes = [utils.sentence_hash(sentence) for sentence in scm.sentences]
+        if not numpy.array_equal(vector_store.get_hashes(cluster), hashes):
+            logging.warn('Sentences of cluster {} differ from the vector store; '\
+                         'ignoring it'.format(cluster))
+            return None
+        
+        return scm
+    
+    def _store_row_filters(self, vector_store, clusters_dir, clusters, pre_tokenized,
+                           near_duplicate_threshold, avoid_data, filter_out_t, filter_out_h,
+                           min_t_size, max_t_size, min_h_size, max_h_size):
+        '''
+        Check which rows of the vector store can be used as T and as H and find 
+        their content words, loading each of the given clusters once. Return a 
+        tuple (valid_t, valid_h, content_words) with two boolean arrays and a 
+        sparse binary matrix, with one element or row for each row of the store.
+        Rows of other clusters, or of clusters whose sentences differ from the 
+        store, are not valid. See `find_rte_candidates_across_clusters`.
+        '''
+        valid_t = numpy.zeros(vector_store.num_sentences, numpy.bool_)
+        valid_h = numpy.zeros(vector_store.num_sentences, numpy.bool_)
+        content_blocks = []
+        num_terms = len(self.token_dict.token2id)
+        
+        clusters = set(clusters)
+        for cluster, (start, end, _) in vector_store.clusters.items():
+            scm = None
+            if cluster in clusters:
+                scm = self._load_store_cluster(vector_store, clusters_dir, cluster, 
+                                               pre_tokenized, near_duplicate_threshold)
+            if scm is None:
+                content_blocks.append(scipy.sparse.csr_matrix((end - start, num_terms), 
+                                                              dtype=numpy.int32))
+                continue
+            
+            avoid_sentences = None
+            if avoid_data is not None:
+                avoid_sentences = avoid_data.get(cluster)
+            if isinstance(avoid_sentences, list):
+                avoid_sentences = set(avoid_sentences)
+            avoid_sentences = avoid_sentences or frozenset()
+            
+            scm.set_yield_tokens()
+            cluster_tokens = list(scm)
+            sentences = scm.sentences
+            sizes = numpy.array([len(tokens) for tokens in cluster_tokens], dtype=numpy.int64)
+            avoided = numpy.array([sentence in avoid_sentences for sentence in sentences],
+                                  dtype=numpy.bool_)
+            valid_t[start:end] = _rejection_codes(sentences, sizes, avoided, filter_out_t, 
+                                                  min_t_size, max_t_size) == 0
+            valid_h[start:end] = _rejection_codes(sentences, sizes, avoided, filter_out_h, 
+                                                  min_h_size, max_h_size) == 0
+            content_blocks.append(self._content_word_matrix(cluster_tokens))
+        
+        if not content_blocks:
+            return valid_t, valid_h, scipy.sparse.csr_matrix((0, num_terms), dtype=numpy.int32)
+        
+        return valid_t, valid_h, scipy.sparse.vstack(content_blocks, format='csr')
+    
+    def find_rte_candidates_across_clusters(self, clusters_dir, vector_store, 
+                                            pre_tokenized=False, 
+                                            min_score=0.8, num_pairs=0,
+                                            absolute_min_alpha=3,
+                                            min_alpha=0.2, max_alpha=1,
+                                            max_score=0.99,
+                                            min_t_size=5, min_h_size=5,
+                                            max_t_size=0, max_h_size=0,
+                                            filter_out_t=lambda _: False,
+                                            filter_out_h=lambda _: False,
+                                            avoid_data=None, neighbors=10,
+                                            num_tables=16, num_bits=8,
+                                            near_duplicate_threshold=None):
+        '''
+        Find and return RTE candidates whose T and H come from different clusters.
+        
+        The vectors of all clusters are read from the vector store and indexed
+        with random hyperplane LSH (see `annindex.HyperplaneLSHIndex`). The 
+        approximate nearest neighbours of each sentence in other clusters are 
+        checked with the same filters as `find_rte_candidates_in_cluster`, whose
+        parameters have the same meaning.
+        
+        :param clusters_dir: the directory containing the cluster directories
+        :param num_pairs: maximum number of pairs whose T comes from each cluster;
+            0 means indefinite
+        :param vector_store: a vectorstore.ClusterVectorStore object with the
+            vectors of all clusters
+        :param avoid_data: object mapping cluster names to sentences to be 
+            avoided, with a `get` method (see `avoidset.load_avoid_data`)
+        :param neighbors: number of neighbours retrieved for each sentence
+        :param num_tables: number of LSH tables
+        :param num_bits: number of bits in each LSH table
+        '''
+        if not self.vector_store_matches_model(vector_store):
+            raise ValueError('The vector store was created with another model')
+        
+        clusters = [cluster for cluster in vector_store.clusters
+                    if os.path.isdir(os.path.join(clusters_dir, cluster))]
+        cluster_starts = numpy.array([vector_store.clusters[cluster][0] 
+                                      for cluster in vector_store.clusters])
+        cluster_names = list(vector_store.clusters)
+        
+        # neighbours come from clusters spread across the corpus, so everything
+        # the filters need is computed for all rows beforehand, loading each 
+        # cluster only once
+        valid_t, valid_h, content_words = self._store_row_filters(
+            vector_store, clusters_dir, clusters, pre_tokenized, near_duplicate_threshold,
+            avoid_data, filter_out_t, filter_out_h, min_t_size, max_t_size, 
+            min_h_size, max_h_size)
+        
+        logging.info('Indexing {} sentence vectors'.format(vector_store.num_sentences))
+        index = annindex.HyperplaneLSHIndex(vector_store.vectors, num_tables, num_bits)
+        
+        def content_word_ids(row):
+            return content_words.indices[content_words.indptr[row]:content_words.indptr[row + 1]]
+        
+        # rows of the store with sentences already used in pairs
+        ignored_rows = set()
+        
+        # tuples (T row, H row, similarity, alpha1, alpha2)
+        found_pairs = []
+        
+        for cluster in clusters:
+            start, end, _ = vector_store.clusters[cluster]
+            def same_cluster(ids):
+                return (ids >= start) & (ids < end)
+            
+            cluster_pairs = 0
+            for base_row in range(start, end):
+                if not valid_t[base_row] or base_row in ignored_rows:
                     continue
                 
-                pair = rte_data.Pair(base_sent, other_sent, similarity=str(similarity),
-                                     alpha1=str(proportion1), alpha2=str(proportion2))
-                pair.set_t_attributes(sentence=str(i))
-                pair.set_h_attributes(sentence=str(arg))
-                candidate_pairs.append(pair)
-                
-                if len(candidate_pairs) == num_pairs:
-                    return candidate_pairs
+                base_content = content_word_ids(base_row)
+                ids, similarities = index.query(vector_store.vectors[base_row], neighbors,
+                                                min_score, same_cluster, 
+                                                index.codes[:, base_row])
                 
-                ignored_sents.add(base_sent)
-                ignored_sents.add(other_sent)
+                for row, similarity in zip(ids, similarities):
+                    if similarity >= max_score:
+                        # essentially the same sentence
+                        continue
+                    
+                    if not valid_h[row] or row in ignored_rows:
+                        continue
+                    
+                    other_content = content_word_ids(row)
+                    overlap = numpy.intersect1d(base_content, other_content, 
+                                                assume_unique=True).size
+                    diff1 = len(base_content) - overlap
+                    diff2 = len(other_content) - overlap
+                    if diff1 < absolute_min_alpha or diff2 < absolute_min_alpha:
+                        continue
+                    
+                    proportion1 = diff1 / float(len(base_content))
+                    proportion2 = diff2 / float(len(other_content))
+                    if not (min_alpha <= proportion1 <= max_alpha and 
+                            min_alpha <= proportion2 <= max_alpha):
+                        continue
+                    
+                    found_pairs.append((base_row, row, similarity, proportion1, proportion2))
+                    cluster_pairs += 1
+                    ignored_rows.add(base_row)
+                    ignored_rows.add(row)
+                    
+                    # avoid using more than one H for the same T
+                    break
                 
-                # avoid using more than one H for the same T
-                break
+                if num_pairs and cluster_pairs == num_pairs:
+                    break
+        
+        # the sentences of the pairs are read loading each cluster once more
+        cluster_rows = {}
+        for row in set(row for pair in found_pairs for row in pair[:2]):
+            cluster = cluster_names[cluster_starts.searchsorted(row, 'right') - 1]
+            cluster_rows.setdefault(cluster, []).append(row)
+        
+        sentences = {}
+        row_clusters = {}
+        for cluster, rows in cluster_rows.items():
+            scm = self._load_store_cluster(vector_store, clusters_dir, cluster, 
+                                           pre_tokenized, near_duplicate_threshold)
+            start = vector_store.clusters[cluster][0]
+            for row in rows:
+                sentences[row] = scm[row - start]
+                row_clusters[row] = cluster
+        
+        candidate_pairs = []
+        for base_row, row, similarity, proportion1, proportion2 in found_pairs:
+            cluster = row_clusters[base_row]
+            other_cluster = row_clusters[row]
+            pair = rte_data.Pair(sentences[base_row], sentences[row], similarity=str(similarity),
+                                 alpha1=str(proportion1), alpha2=str(proportion2))
+            pair.set_t_attributes(sentence=str(base_row - vector_store.clusters[cluster][0]),
+                                  cluster=cluster)
+            pair.set_h_attributes(sentence=str(row - vector_store.clusters[other_cluster][0]),
+                                  cluster=other_cluster)
+            candidate_pairs.append(pair)
         
         return candidate_pairs
     
@@ -451,13 +1529,78 @@ if __name__ == '__main__':
                         action='store_true', 
                         help='Load previously saved corpus metadata. Only used by the '\
                         'SentenceCorpusManager')
+    parser.add_argument('--no-sentence-cache', dest='sentence_cache', action='store_false',
+                        help='Do not cache sentence boundaries of corpus files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to split and tokenize the corpus '\
+                        '(default 1)')
+    parser.add_argument('--token-stream', dest='token_stream', action='store_true',
+                        help='Tokenize the corpus only once, saving a token stream file that '\
+                        'is read in all subsequent passes')
+    parser.add_argument('--load-token-stream', dest='load_token_stream', action='store_true',
+                        help='Read a token stream file saved previously with --token-stream '\
+                        'instead of the corpus')
+    parser.add_argument('--max-dict-tokens', dest='max_dictionary_tokens', type=int,
+                        default=2000000,
+                        help='Maximum number of distinct tokens kept in memory while creating '\
+                        'the dictionary; the least frequent ones are pruned (default 2000000)')
+    parser.add_argument('--update', action='store_true',
+                        help='Update the models in --dir with the corpus files that are new '\
+                        'or were modified since they were generated, instead of training '\
+                        'new ones. The vocabulary is not changed, and the method and '\
+                        'stopwords arguments are ignored')
+    parser.add_argument('--create-index', dest='create_index', action='store_true',
+                        help='Also create a similarity index over the whole corpus')
+    parser.add_argument('--index-dir', dest='index_dir', default=None,
+                        help='Directory to save the corpus index (default: same as --dir)')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Also save a bundle file with everything needed to mine '\
+                        'candidate pairs, which loads much faster (only lsi and rp)')
+    parser.add_argument('--shard-size', dest='shard_size', type=int, default=32768,
+                        help='Maximum number of documents in each index shard (default 32768)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the random numbers used to build the models, making '\
+                        'them reproducible (default: not seeded)')
     args = parser.parse_args()
+    if args.update and (args.load_dictionary or args.load_corpus_metadata or 
+                        args.token_stream or args.load_token_stream):
+        parser.error('--update reads the corpus directory and the saved dictionary; it '\
+                     'can\'t be used with --load-dict, --load-corpus-metadata or token streams')
+    
+    if args.bundle:
+        method = args.method
+        metadata_file = FileAccess(args.dir).vsa_metadata
+        if args.update and os.path.exists(metadata_file):
+            # the method of the saved models is kept
+            with open(metadata_file, 'rb') as f:
+                method = cPickle.load(f)['method']
+        
+        if method not in ('lsi', 'rp'):
+            parser.error('--bundle can only be used with the lsi and rp methods')
     
     if not args.quiet:
         logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', 
                             level=logging.INFO)
     
+    if args.seed is not None:
+        # gensim models draw from numpy's global generator
+        numpy.random.seed(args.seed)
+    
     vsa = VectorSpaceAnalyzer()
-    vsa.generate_model(args.corpus_dir, args.dir, args.method, args.load_dictionary, 
-                       args.stopwords, args.num_topics, load_metadata=args.load_corpus_metadata)
+    if args.update:
+        vsa.update_model(args.corpus_dir, args.dir, sentence_cache=args.sentence_cache,
+                         workers=args.workers)
+    else:
+        vsa.generate_model(args.corpus_dir, args.dir, args.method, args.load_dictionary, 
+                           args.stopwords, args.num_topics, token_stream=args.token_stream,
+                           load_token_stream=args.load_token_stream,
+                           max_dictionary_tokens=args.max_dictionary_tokens,
+                           load_metadata=args.load_corpus_metadata,
+                           sentence_cache=args.sentence_cache, workers=args.workers)
+    
+    if args.bundle:
+        vsa.save_bundle()
+    
+    if args.create_index:
+        vsa.create_index(args.index_dir, args.shard_size)
     
\ No newline at end of file
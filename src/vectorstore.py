@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''
+Consolidated storage for the sentence vectors of all clusters in a corpus.
+
+Instead of one index file inside each cluster directory, the vectors of all
+clusters are kept in a single contiguous float32 matrix, along with an offsets
+table keyed by cluster name and the hash of the sentence in each row.
+'''
+
+import os
+import logging
+import cPickle
+from collections import OrderedDict
+
+import numpy
+
+from config import FileAccess
+
+class ClusterVectorStore(object):
+    '''
+    Class to read a cluster vector store. The matrices are memory mapped, so
+    the vectors of a cluster are returned without any copying.
+    '''
+    def __init__(self, directory):
+        '''
+        :param directory: the directory containing the store files
+        '''
+        file_access = FileAccess(directory)
+        with open(file_access.vector_store_metadata, 'rb') as f:
+            metadata = cPickle.load(f)
+        
+        self.num_features = metadata['num_features']
+        self.num_sentences = metadata['num_sentences']
+        
+        # maps cluster names to tuples (start row, end row, fingerprint)
+        self.clusters = metadata['clusters']
+        
+        if self.num_sentences == 0:
+            # numpy can't map empty files
+            self.vectors = numpy.zeros((0, self.num_features), numpy.float32)
+            self.hashes = numpy.zeros(0, numpy.uint64)
+        else:
+            shape = (self.num_sentences, self.num_features)
+            self.vectors = numpy.memmap(file_access.vector_store, numpy.float32, 'r',
+                                        shape=shape)
+            self.hashes = numpy.memmap(file_access.vector_store_hashes, numpy.uint64, 'r',
+                                       shape=(self.num_sentences,))
+    
+    def __contains__(self, cluster):
+        return cluster in self.clusters
+    
+    def __len__(self):
+        return len(self.clusters)
+    
+    def get_fingerprint(self, cluster):
+        '''
+        Return the fingerprint of the files and model used to create the
+        vectors of the given cluster.
+        '''
+        return self.clusters[cluster][2]
+    
+    def get_vectors(self, cluster):
+        '''
+        Return the matrix with the normalized sentence vectors of the cluster.
+        '''
+        start, end, _ = self.clusters[cluster]
+        return self.vectors[start:end]
+    
+    def get_hashes(self, cluster):
+        '''
+        Return an array with the hashes of the cluster sentences
+        (see `utils.sentence_hash`).
+        '''
+        start, end, _ = self.clusters[cluster]
+        return self.hashes[start:end]
+
+class ClusterVectorStoreWriter(object):
+    '''
+    Class to write a cluster vector store, one cluster at a time. Files are
+    written with temporary names and only replace an existing store in the
+    same directory when `close` is called.
+    '''
+    def __init__(self, directory, num_features):
+        '''
+        :param directory: the directory where the store files are written. It 
+            is created if it doesn't exist.
+        :param num_features: the dimension of the sentence vectors
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        self.file_access = FileAccess(directory)
+        self.num_features = num_features
+        self.num_sentences = 0
+        self.clusters = OrderedDict()
+        
+        self.vectors_file = open(self.file_access.vector_store + '.tmp', 'wb')
+        self.hashes_file = open(self.file_access.vector_store_hashes + '.tmp', 'wb')
+    
+    def add_cluster(self, cluster, vectors, hashes, fingerprint=None):
+        '''
+        Append the vectors of a cluster to the store.
+        
+        :param vectors: matrix with one normalized vector per sentence
+        :param hashes: array with the hash of each sentence
+        :param fingerprint: the cluster fingerprint
+        '''
+        if cluster in self.clusters:
+            raise ValueError('Cluster {} was already added to the store'.format(cluster))
+        
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        if vectors.shape != (len(hashes), self.num_features):
+            msg = 'Expected {} vectors of dimension {}, got shape {}'
+            raise ValueError(msg.format(len(hashes), self.num_features, vectors.shape))
+        
+        start = self.num_sentences
+        self.num_sentences += len(hashes)
+        self.clusters[cluster] = (start, self.num_sentences, fingerprint)
+        
+        self.vectors_file.write(numpy.ascontiguousarray(vectors).tostring())
+        self.hashes_file.write(hashes.tostring())
+    
+    def close(self):
+        '''
+        Finish writing the store, replacing any previous one.
+        '''
+        self.vectors_file.close()
+        self.hashes_file.close()
+        
+        metadata = {'num_features': self.num_features,
+                    'num_sentences': self.num_sentences,
+                    'clusters': self.clusters}
+        with open(self.file_access.vector_store_metadata + '.tmp', 'wb') as f:
+            cPickle.dump(metadata, f, -1)
+        
+        for filename in [self.file_access.vector_store,
+                         self.file_access.vector_store_hashes,
+                         self.file_access.vector_store_metadata]:
+            os.rename(filename + '.tmp', filename)
+        
+        logging.info('Saved vectors of {} sentences in {} clusters'.format(self.num_sentences,
+                                                                           len(self.clusters)))